@@ -10,7 +10,7 @@ from django.contrib.auth.admin import UserAdmin, GroupAdmin
 
 from django.contrib.auth.models import User, Group
 
-from chat.message import store_question
+from chat.tasks import queue_questions
 from chat.models import ChatBot, Field, Message, Thread
 
 
@@ -90,8 +90,7 @@ class MessageAdmin(admin.ModelAdmin):
     actions = ["index_questions"]
 
     def index_questions(self, request, queryset):
-        for message in queryset.filter(role="user"):
-            store_question(message, message.thread.bot)
+        queue_questions(queryset.filter(role="user").only("pk"))
 
 
 class CustomUserAdmin(UserAdmin):
@@ -0,0 +1,139 @@
+"""
+Semantic answer cache on top of the per-bot question store.
+
+Questions are stored with a payload naming the answer and documents they
+got. A new question to a bot with ``answer_cache`` enabled is matched
+against recent questions with the same field values and bot config; above
+the bot's similarity threshold the stored answer is returned instead of
+calling the LLM.
+"""
+
+import json
+import time
+from collections import Counter
+from hashlib import sha1
+from typing import Dict, List, Optional, Tuple
+
+from django.core.cache import cache
+from qdrant_client.http.models import models
+
+from chat.message import embed_questions, question_dimension, question_store
+from chat.models import ChatBot, Message
+from context.embeddings import collection_params, qdrant_client, uses_local_index
+from context.models import Document
+from context.search import load_documents
+from core.cache import increment
+
+# Counters of this process, the ones in the Django cache are shared
+stats: Counter = Counter()
+
+EVENTS = [
+    "hit",
+    "miss",
+    "bypass:disabled",
+    "bypass:local_index",
+    "bypass:no_store",
+    "bypass:answer_deleted",
+]
+
+
+def config_version(bot: ChatBot, fields: List[str]) -> str:
+    """Changes whenever something that shapes the answers of the bot changes."""
+    config = [
+        bot.system_prompt_template,
+        bot.user_prompt_template,
+        bot.model,
+        bot.base_url,
+        bot.functions,
+        bot.context_provider_id,
+        sorted(fields),
+    ]
+    return sha1(json.dumps(config, sort_keys=True, default=str).encode()).hexdigest()
+
+
+def _record(bot: ChatBot, event: str):
+    stats[(bot.slug, event)] += 1
+
+    increment(cache, f"answer-cache:{bot.slug}:{event}")
+
+
+def bot_stats(bot: ChatBot) -> Dict[str, int]:
+    counts = cache.get_many([f"answer-cache:{bot.slug}:{event}" for event in EVENTS])
+    return {
+        event: counts.get(f"answer-cache:{bot.slug}:{event}", 0) for event in EVENTS
+    }
+
+
+def question_payload(
+    bot: ChatBot, fields: Dict[str, str], answer: Message, docs: List[Document]
+) -> dict:
+    return {
+        "cacheable": True,
+        "config": config_version(bot, list(fields)),
+        "fields": fields,
+        "answer": answer.pk,
+        "docs": [doc.pk for doc in docs],
+        "created_at": time.time(),
+    }
+
+
+def lookup(
+    question: str, bot: ChatBot, fields: Dict[str, str]
+) -> Optional[Tuple[Message, List[Document]]]:
+    """Returns the answer and documents of a similar recent question, if any."""
+    if not bot.answer_cache:
+        _record(bot, "bypass:disabled")
+        return None
+    if uses_local_index(bot.context_provider):
+        _record(bot, "bypass:local_index")
+        return None
+
+    store_name = question_store(bot)
+    conditions = [
+        models.FieldCondition(key="cacheable", match=models.MatchValue(value=True)),
+        models.FieldCondition(
+            key="config",
+            match=models.MatchValue(value=config_version(bot, list(fields))),
+        ),
+        models.FieldCondition(
+            key="created_at",
+            range=models.Range(gte=time.time() - bot.answer_cache_ttl),
+        ),
+    ] + [
+        models.FieldCondition(
+            key=f"fields.{slug}", match=models.MatchValue(value=value)
+        )
+        for slug, value in fields.items()
+    ]
+
+    with qdrant_client() as client:
+        params = collection_params(client, store_name)
+        # A store at another size is rebuilt by the next store_questions
+        if params is None or params.size != question_dimension(bot):
+            _record(bot, "bypass:no_store")
+            return None
+
+        hits = client.search(
+            store_name,
+            embed_questions([question], bot)[0],
+            query_filter=models.Filter(must=conditions),
+            limit=1,
+            score_threshold=bot.answer_cache_threshold,
+            with_payload=True,
+        )
+
+    if not hits:
+        _record(bot, "miss")
+        return None
+
+    payload = hits[0].payload
+    answer = Message.objects.filter(pk=payload["answer"]).first()
+    if answer is None:
+        _record(bot, "bypass:answer_deleted")
+        return None
+
+    found = load_documents(payload["docs"])
+    docs = [found[pk] for pk in payload["docs"] if pk in found]
+
+    _record(bot, "hit")
+    return answer, docs
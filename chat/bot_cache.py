@@ -0,0 +1,108 @@
+"""
+Per-process cache of resolved bot configuration.
+
+Chat requests get their bot from here with its collection and fields
+already loaded, so the hot path runs no queries for them. Saving or
+deleting a bot, field or collection clears this process' cache and bumps a
+version counter in the shared cache (BOT_CONFIG_CACHE), which the other
+processes compare against on every lookup. Entries also expire after
+BOT_CONFIG_TTL, in case no shared cache is configured. Without one, the
+live vectors of the bot's collection are compared on every lookup, since
+a rebuild in another process may have switched them (queries have to be
+embedded like them).
+"""
+
+import threading
+import time
+from typing import Dict, Tuple
+
+from django.conf import settings
+from django.core.cache import caches
+from django.core.cache.backends.dummy import DummyCache
+
+from chat.models import ChatBot
+from context.models import Collection
+from core.cache import increment
+
+VERSION_KEY = "chatbot-config-version"
+
+# The embedding and backend of the live vectors, see Collection.indexed_embedding
+LIVE_FIELDS = ("indexed_embedding", "indexed_dimension", "indexed_backend")
+
+_lock = threading.Lock()
+# Bot, shared version and load time, by slug
+_bots: Dict[str, Tuple[ChatBot, int, float]] = {}
+
+
+def _shared_cache():
+    if not settings.BOT_CONFIG_CACHE:
+        return None
+    cache = caches[settings.BOT_CONFIG_CACHE]
+    # Shares nothing, e.g. the default dummycache://
+    if isinstance(cache, DummyCache):
+        return None
+    return cache
+
+
+def _queryset():
+    return ChatBot.objects.select_related("context_provider").prefetch_related(
+        "field_set"
+    )
+
+
+def _cached(slug: str, version: int):
+    with _lock:
+        entry = _bots.get(slug)
+    if entry is None:
+        return None
+    bot, bot_version, loaded_at = entry
+    if bot_version != version or time.monotonic() - loaded_at > settings.BOT_CONFIG_TTL:
+        return None
+    return bot
+
+
+def _remember(slug: str, bot: ChatBot, version: int):
+    with _lock:
+        _bots[slug] = (bot, version, time.monotonic())
+
+
+async def aget_bot(slug: str) -> ChatBot:
+    """
+    Returns the bot with its collection and fields (``bot.field_set.all()``).
+
+    The instance is shared, treat it as read-only.
+    """
+    shared = _shared_cache()
+    version = (await shared.aget(VERSION_KEY) if shared is not None else None) or 0
+
+    bot = _cached(slug, version)
+    if bot is not None and shared is None and not await _is_live(bot):
+        bot = None
+    if bot is None:
+        bot = await _queryset().aget(slug=slug)
+        _remember(slug, bot, version)
+    return bot
+
+
+async def _is_live(bot: ChatBot) -> bool:
+    """Whether the cached collection still has the live vectors of the database."""
+    if bot.context_provider_id is None:
+        return True
+    current = (
+        await Collection.objects.filter(pk=bot.context_provider_id)
+        .values(*LIVE_FIELDS)
+        .afirst()
+    )
+    return current is None or all(
+        getattr(bot.context_provider, field) == current[field] for field in LIVE_FIELDS
+    )
+
+
+def invalidate():
+    """Drops the cached bots of all processes."""
+    with _lock:
+        _bots.clear()
+
+    shared = _shared_cache()
+    if shared is not None:
+        increment(shared, VERSION_KEY)
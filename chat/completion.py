@@ -1,12 +1,16 @@
+import re
+from functools import lru_cache
 from typing import List, Optional
 
-import openai
+import tiktoken
+from asgiref.sync import sync_to_async
 from django.conf import settings
 
 from chat.models import ChatBot, Message, Thread
 from context.models import Document
 
 from chat.guards import create_guard
+from context.clients import async_openai_client, openai_client
 
 
 def format_doc(doc: Document):
@@ -17,6 +21,74 @@ def format_doc(doc: Document):
     return f"[{doc.content}]\n({doc.page.url if doc.page else doc.pk}{date})\n"
 
 
+@lru_cache(maxsize=None)
+def tokenizer(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        # Models of other providers, close enough for budgeting
+        return tiktoken.get_encoding("o200k_base")
+
+
+def count_tokens(text: str, bot: ChatBot) -> int:
+    return len(tokenizer(bot.model).encode(text, disallowed_special=()))
+
+
+def _words(text: str):
+    return set(re.findall(r"\w+", text.lower()))
+
+
+def _similarity(a: set, b: set) -> float:
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+
+def pack_documents(docs: List[Document], bot: ChatBot, budget: int) -> List[Document]:
+    """
+    Selects the documents that go into the prompt, in their given order.
+
+    Skips documents less similar than the bot's minimum (or too far below
+    the best hit), near-duplicates of documents already selected and
+    documents that no longer fit into the token budget. The thresholds apply
+    to the cosine similarity of dense hits only, fused and full-text scores
+    are ranks on another scale.
+    """
+    scores = [
+        doc.similarity for doc in docs if getattr(doc, "similarity", None) is not None
+    ]
+    cutoff = max(scores) * settings.CONTEXT_MIN_RELATIVE_SCORE if scores else None
+
+    selected: List[Document] = []
+    selected_words: List[set] = []
+    used = 0
+
+    for doc in docs:
+        score = getattr(doc, "similarity", None)
+        if score is not None:
+            if bot.context_min_score is not None and score < bot.context_min_score:
+                continue
+            if cutoff is not None and score < cutoff:
+                continue
+
+        words = _words(doc.content)
+        if any(
+            _similarity(words, other) >= settings.CONTEXT_DUPLICATE_SIMILARITY
+            for other in selected_words
+        ):
+            continue
+
+        tokens = count_tokens(format_doc(doc), bot)
+        if used + tokens > budget:
+            continue
+
+        selected.append(doc)
+        selected_words.append(words)
+        used += tokens
+
+    return selected
+
+
 def get_system_prompt(question, bot, docs, **kwargs):
     system_prompt = bot.system_prompt_template.format(
         context="\n".join([format_doc(doc) for doc in docs]),
@@ -35,57 +107,194 @@ def get_messages(question, bot, docs, **kwargs):
 
     guard = create_guard()
 
-    messages = kwargs.pop("messages", [])
+    messages = kwargs.pop("messages", [])[-10:]
+    # Tokens of messages the caller sends along (e.g. an earlier thread)
+    reserved_tokens = kwargs.pop("reserved_tokens", 0)
     user_prompt = get_user_prompt(question, bot, docs, **kwargs, guard=guard)
+
+    # Whatever the prompts and history leave of the input budget goes to the context
+    overhead = (
+        count_tokens(get_system_prompt(question, bot, [], **kwargs, guard=guard), bot)
+        + count_tokens(user_prompt, bot)
+        + sum(count_tokens(message["content"], bot) for message in messages)
+        + reserved_tokens
+    )
+    budget = bot.model_max_length - bot.output_max_length - overhead
+    docs = pack_documents(docs, bot, budget)
+
     system_prompt = get_system_prompt(question, bot, docs, **kwargs, guard=guard)
 
     messages = (
         [{"role": "system", "content": system_prompt}]
-        + messages[-10:]
+        + messages
         + [{"role": "user", "content": user_prompt}]
     )
 
     return messages
 
 
-def get_completion(messages, bot, use_functions=False, **kwargs):
-    if bot.base_url:
-        client = openai.Client(api_key=settings.INFOMANIAK_KEY, base_url=bot.base_url)
-    else:
-        client = openai.Client(api_key=settings.OPENAI_KEY)
-
+def completion_request(messages, bot, **kwargs) -> dict:
     if "tool_choice" in kwargs and kwargs["tool_choice"] != "none":
         tools = bot.functions
     else:
         tools = None
-        
+
     messages = [{"role": message["role"], "content": message["content"]} for message in messages]
 
-    completion = client.chat.completions.create(
-        messages=messages,
-        model=bot.model,
-        tools=tools,
-        **kwargs,
+    kwargs.setdefault("max_tokens", bot.output_max_length)
+
+    return dict(messages=messages, model=bot.model, tools=tools, **kwargs)
+
+
+def provider(bot: ChatBot):
+    """The (base_url, api key) of the bot's LLM provider."""
+    if bot.base_url:
+        return bot.base_url, settings.INFOMANIAK_KEY
+    return "", settings.OPENAI_KEY
+
+
+def get_completion(messages, bot, use_functions=False, **kwargs):
+    client = openai_client(*provider(bot))
+
+    return client.chat.completions.create(**completion_request(messages, bot, **kwargs))
+
+
+async def aget_completion(messages, bot, **kwargs):
+    client = async_openai_client(*provider(bot))
+
+    return await client.chat.completions.create(
+        **completion_request(messages, bot, **kwargs)
     )
-    return completion
 
 
-def generate_answer(question: str, bot: ChatBot, docs: List[Document], **kwargs):
+def thread_history(thread: Thread, bot: ChatBot):
+    """
+    The recent turns of a thread that go into the prompt, at most
+    THREAD_HISTORY_MESSAGES messages and THREAD_HISTORY_TOKENS tokens.
+
+    With summaries enabled, older turns are replaced by the thread's summary.
+    """
+    summarized = bot.summarize_threads and thread.summary
+    after = thread.summary_until if summarized else None
+
+    kept = _history_window(
+        thread.recent_messages(settings.THREAD_HISTORY_MESSAGES, after=after), bot
+    )
+
+    if summarized:
+        kept.insert(
+            0,
+            {
+                "role": "system",
+                "content": f"Summary of the earlier conversation:\n{thread.summary}",
+            },
+        )
+    return kept
+
+
+def _history_window(messages, bot: ChatBot):
+    """The newest of the messages within both history limits, oldest first."""
+    kept = []
+    used = 0
+    for message in reversed(messages[-settings.THREAD_HISTORY_MESSAGES :]):
+        used += count_tokens(message["content"], bot)
+        if used > settings.THREAD_HISTORY_TOKENS:
+            break
+        kept.append(message)
+    return kept[::-1]
+
+
+SUMMARY_PROMPT = (
+    "Summarize the conversation below for the assistant that continues it. "
+    "Keep facts, names, numbers, open questions and what the user is after, "
+    "leave out pleasantries. Write in the language of the conversation."
+)
+
+
+def summarize_thread(thread: Thread):
+    """
+    Folds the older turns of a thread into its rolling summary.
+
+    Every message thread_history no longer sends is summarized, so none
+    drops out of the prompt unsummarized. Once the messages not yet
+    summarized exceed the bot's summary_threshold, all but the newest
+    THREAD_SUMMARY_KEEP_MESSAGES are summarized as well.
+    """
+    bot = thread.bot
+    messages = thread.recent_messages(None, after=thread.summary_until)
+
+    # Messages before the window of the next prompt
+    cut = len(messages) - len(_history_window(messages, bot))
+
+    tokens = sum(count_tokens(message["content"], bot) for message in messages)
+    if tokens > bot.summary_threshold:
+        cut = max(cut, len(messages) - settings.THREAD_SUMMARY_KEEP_MESSAGES)
+
+    older = messages[:cut]
+    if not older:
+        return
+
+    transcript = "\n\n".join(
+        f"{message['role']}: {message['content']}" for message in older
+    )
+    if thread.summary:
+        transcript = f"Summary so far:\n{thread.summary}\n\nConversation:\n{transcript}"
+
+    completion = get_completion(
+        [
+            {"role": "system", "content": SUMMARY_PROMPT},
+            {"role": "user", "content": transcript},
+        ],
+        bot,
+        max_tokens=settings.THREAD_SUMMARY_MAX_TOKENS,
+    )
+    summary = completion.choices[0].message.content or ""
+
+    # Unless another turn's task summarized the thread in the meantime
+    Thread.objects.filter(pk=thread.pk, summary_until=thread.summary_until).update(
+        summary=summary, summary_until=older[-1]["created_at"]
+    )
+
+
+def prepare_answer(question: str, bot: ChatBot, docs: List[Document], fields, **kwargs):
+    """Builds the messages of an answer, returns them with the completion kwargs."""
     messages = kwargs.pop("messages", [])
-    fields = [field.slug for field in bot.field_set.all()]
 
     for field in fields:
         kwargs[field] = kwargs.get(field, "")
 
-    new_messages = get_messages(question, bot, docs, **kwargs)
+    reserved_tokens = sum(count_tokens(message["content"], bot) for message in messages)
+    new_messages = get_messages(
+        question, bot, docs, reserved_tokens=reserved_tokens, **kwargs
+    )
     messages += new_messages
 
     for field in fields:
         kwargs.pop(field, "")
 
+    return messages, new_messages, kwargs
+
+
+def generate_answer(question: str, bot: ChatBot, docs: List[Document], **kwargs):
+    fields = [field.slug for field in bot.field_set.all()]
+    messages, new_messages, kwargs = prepare_answer(
+        question, bot, docs, fields, **kwargs
+    )
+
     return get_completion(messages, bot, **kwargs), new_messages
 
 
+async def agenerate_answer(question: str, bot: ChatBot, docs: List[Document], **kwargs):
+    """Async variant of generate_answer."""
+    fields = [field.slug async for field in bot.field_set.all()]
+    # Token counting is CPU bound, keep it off the event loop
+    messages, new_messages, kwargs = await sync_to_async(
+        prepare_answer, thread_sensitive=False
+    )(question, bot, docs, fields, **kwargs)
+
+    return await aget_completion(messages, bot, **kwargs), new_messages
+
+
 def generate_function_call(
     question: str, bot: ChatBot, docs: List[Document], function: Optional[str], **kwargs
 ):
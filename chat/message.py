@@ -1,65 +1,254 @@
+import re
+from typing import Dict, List, Optional
+
+import numpy as np
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
 from context.embeddings import (
-    get_embedding,
-    load_encoder,
-    qdrant_client,
-    generate_embeddings,
+    OPENAI_EMBEDDING_DIMENSIONS,
+    OPENAI_EMBEDDING_MODEL,
+    collection_params,
+    create_collection,
+    delete_collection,
+    embedding_dimension,
+    forget_collection,
     generate_embeddings_openai,
-    collection_exists,
+    get_alias,
+    names,
+    point_alias,
+    qdrant_client,
+    uses_local_index,
 )
+from context.query_cache import embed_queries
+from context.vector_index import LocalIndex
 
 from chat.models import ChatBot, Message
-from context.models import Collection
 from qdrant_client.http.models import models
 
 
-def store_question(msg: Message, bot: ChatBot):
-    store_name = bot.slug + "_questions"
+def embed_questions(texts, bot: ChatBot):
+    """
+    Embeds questions with the embedding config of the bot's collection.
 
+    These go through the query embedding cache, so a question is embedded
+    once for the search, the answer cache and the question store.
+    """
     if bot.context_provider:
-        use_openai = bot.context_provider.use_openai
-    else:
-        use_openai = True
+        return np.stack(embed_queries(texts, bot.context_provider))
+    return generate_embeddings_openai(texts)
 
-    with qdrant_client() as client:
-        if (
-            collection_exists(client, store_name)
-            and len(client.retrieve(collection_name=store_name, ids=[msg.pk])) > 0
-        ):
+
+def question_dimension(bot: ChatBot) -> int:
+    if bot.context_provider:
+        return embedding_dimension(bot.context_provider)
+    return OPENAI_EMBEDDING_DIMENSIONS[OPENAI_EMBEDDING_MODEL]
+
+
+def question_store(bot: ChatBot) -> str:
+    return bot.slug + "_questions"
+
+
+def _rebuild_question_store(client, bot: ChatBot, store_name: str):
+    """
+    Re-embeds the stored questions into a new version of the store, at the
+    size of the bot's current embedding, keeping their payloads. The store
+    name becomes an alias of the new version.
+
+    Runs while holding a lock on the bot's row; if another worker holds it,
+    raises so the task is retried.
+    """
+    dimension = question_dimension(bot)
+
+    with transaction.atomic():
+        if not ChatBot.objects.select_for_update(skip_locked=True).filter(pk=bot.pk):
+            raise RuntimeError(f"Question store {store_name} is being rebuilt")
+
+        # Another worker may have rebuilt it since the size was cached
+        forget_collection(store_name)
+        params = collection_params(client, store_name)
+        if params is None or params.size == dimension:
             return
 
-        if use_openai:
-            embeddings = generate_embeddings_openai([msg.content])
-        else:
-            assert bot.context_provider is not None
-            embeddings = generate_embeddings(
-                [msg.content], load_encoder(bot.context_provider.language)
+        old = get_alias(client, store_name) or store_name
+        target = f"{store_name}.v{timezone.now():%Y%m%d%H%M%S%f}"
+        create_collection(
+            client,
+            target,
+            models.VectorParams(size=dimension, distance=models.Distance.COSINE),
+        )
+
+        offset = None
+        while True:
+            points, offset = client.scroll(
+                old,
+                limit=settings.QUESTION_INDEX_BATCH_SIZE,
+                offset=offset,
+                with_payload=True,
             )
+            payloads = {point.id: point.payload for point in points}
+            messages = list(Message.objects.filter(pk__in=list(payloads)))
+            if messages:
+                embeddings = embed_questions([msg.content for msg in messages], bot)
+                client.upsert(
+                    collection_name=target,
+                    points=[
+                        models.PointStruct(
+                            id=msg.pk,
+                            vector=embedding.tolist(),
+                            payload=payloads[msg.pk],
+                        )
+                        for msg, embedding in zip(messages, embeddings)
+                    ],
+                )
+            if offset is None:
+                break
+
+        point_alias(client, store_name, target)
+
+        # The previous version and any left over by failed rebuilds
+        for name in names(client.get_collections()):
+            if name != target and re.fullmatch(rf"{re.escape(store_name)}\.v\d+", name):
+                delete_collection(client, name)
+
+
+def _question_embeddings(
+    messages: List[Message], bot: ChatBot, vectors: Dict[int, list]
+) -> np.ndarray:
+    """Embeds the messages, reusing the given vectors (e.g. from the request) at the right size."""
+    dimension = question_dimension(bot)
+    vectors = {pk: vector for pk, vector in vectors.items() if len(vector) == dimension}
+
+    missing = [msg for msg in messages if msg.pk not in vectors]
+    if missing:
+        embeddings = embed_questions([msg.content for msg in missing], bot)
+        vectors.update(zip([msg.pk for msg in missing], embeddings))
+
+    return np.stack([np.asarray(vectors[msg.pk], dtype=np.float32) for msg in messages])
+
+
+def _rebuild_questions_local(index: LocalIndex, bot: ChatBot):
+    """Re-embeds the stored questions at the size of the bot's current embedding."""
+    building = LocalIndex(f"{index.name}.v{timezone.now():%Y%m%d%H%M%S%f}")
+    building.create(question_dimension(bot))
+
+    ids = [int(pk) for pk in index.rows()["id"]]
+    size = settings.QUESTION_INDEX_BATCH_SIZE
+    for start in range(0, len(ids), size):
+        messages = list(Message.objects.filter(pk__in=ids[start : start + size]))
+        if messages:
+            building.upsert(
+                [msg.pk for msg in messages],
+                embed_questions([msg.content for msg in messages], bot),
+            )
+
+    index.replace_with(building)
+
+
+def _store_questions_local(
+    messages: List[Message], bot: ChatBot, store_name: str, vectors: Dict[int, list]
+):
+    index = LocalIndex(store_name)
+
+    with index.lock():
+        if index.exists() and index.dimension() != question_dimension(bot):
+            _rebuild_questions_local(index, bot)
+
+    if index.exists():
+        messages = [msg for msg in messages if index.retrieve(msg.pk) is None]
+    if not messages:
+        return
+
+    embeddings = _question_embeddings(messages, bot, vectors)
+    index.ensure(embeddings.shape[-1])
+    index.upsert([msg.pk for msg in messages], embeddings)
+
+
+def store_questions(
+    messages: List[Message],
+    bot: ChatBot,
+    payloads: Optional[Dict[int, dict]] = None,
+    vectors: Optional[Dict[int, list]] = None,
+):
+    """
+    Embeds user messages into the bot's question store, in one batch.
+
+    Points are keyed by message pk and messages already stored are skipped,
+    so storing a message twice (e.g. on a retry) is harmless. The payloads
+    (by message pk, see chat.answer_cache) are only kept in Qdrant. Messages
+    with a vector (by message pk, embedded by the request) are not embedded
+    again.
+    """
+    store_name = question_store(bot)
+    payloads = payloads or {}
+    vectors = vectors or {}
+
+    if uses_local_index(bot.context_provider):
+        _store_questions_local(messages, bot, store_name, vectors)
+        return
+
+    with qdrant_client() as client:
+        params = collection_params(client, store_name)
+
+        if params is not None and params.size != question_dimension(bot):
+            # The embedding config of the bot changed
+            _rebuild_question_store(client, bot, store_name)
+
+        if params is not None:
+            stored = {
+                point.id
+                for point in client.retrieve(
+                    collection_name=store_name, ids=[msg.pk for msg in messages]
+                )
+            }
+            messages = [msg for msg in messages if msg.pk not in stored]
+        if not messages:
+            return
+
+        embeddings = _question_embeddings(messages, bot, vectors)
 
         embedding_dim = embeddings.shape[-1]
 
-        if not collection_exists(client, store_name):
-            client.create_collection(
+        if params is None:
+            create_collection(
+                client,
                 store_name,
                 models.VectorParams(
                     size=embedding_dim, distance=models.Distance.COSINE
                 ),
             )
-        client.upload_records(
+        client.upsert(
             collection_name=store_name,
-            records=[models.Record(id=msg.pk, vector=embeddings[0])],
+            points=[
+                models.PointStruct(
+                    id=msg.pk, vector=embedding.tolist(), payload=payloads.get(msg.pk)
+                )
+                for msg, embedding in zip(messages, embeddings)
+            ],
         )
-        print("Stored point", msg.pk)
-
+        print("Stored points", [msg.pk for msg in messages])
 
-def retrieve_questions(msg: Message, bot: ChatBot, n=50, offset=0):
-    store_name = bot.slug + "_questions"
 
+def _search_questions_qdrant(msg: Message, store_name: str, n: int, offset: int):
     with qdrant_client() as client:
         vector = client.retrieve(
             collection_name=store_name, ids=[msg.pk], with_vectors=True
         )[0].vector
         assert vector is not None
-        msgs = client.search(store_name, vector, limit=n, offset=offset)
+        return client.search(store_name, vector, limit=n, offset=offset)
+
+
+def retrieve_questions(msg: Message, bot: ChatBot, n=50, offset=0):
+    store_name = question_store(bot)
+
+    if uses_local_index(bot.context_provider):
+        index = LocalIndex(store_name)
+        vector = index.retrieve(msg.pk)
+        assert vector is not None
+        msgs = index.search(vector, limit=n, offset=offset)
+    else:
+        msgs = _search_questions_qdrant(msg, store_name, n, offset)
 
     pks = [r.id for r in msgs]
     scores = [r.score for r in msgs]
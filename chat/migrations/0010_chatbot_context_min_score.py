@@ -0,0 +1,18 @@
+# Generated by Django 5.1.1 on 2026-10-18 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0009_chatbot_description"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatbot",
+            name="context_min_score",
+            field=models.FloatField(blank=True, null=True),
+        ),
+    ]
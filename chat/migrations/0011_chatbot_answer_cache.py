@@ -0,0 +1,28 @@
+# Generated by Django 5.1.1 on 2026-10-18 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0010_chatbot_context_min_score"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatbot",
+            name="answer_cache",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="chatbot",
+            name="answer_cache_threshold",
+            field=models.FloatField(default=0.95),
+        ),
+        migrations.AddField(
+            model_name="chatbot",
+            name="answer_cache_ttl",
+            field=models.IntegerField(default=3600, help_text="Seconds"),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.1 on 2026-10-18 17:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0011_chatbot_answer_cache"),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name="message",
+            index=models.Index(
+                fields=["thread", "created_at"], name="chat_msg_thread_created_idx"
+            ),
+        ),
+    ]
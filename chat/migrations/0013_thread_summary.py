@@ -0,0 +1,35 @@
+# Generated by Django 5.1.1 on 2026-10-18 18:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0012_message_chat_msg_thread_created_idx"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="chatbot",
+            name="summarize_threads",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="chatbot",
+            name="summary_threshold",
+            field=models.IntegerField(
+                default=2000, help_text="Tokens of unsummarized history"
+            ),
+        ),
+        migrations.AddField(
+            model_name="thread",
+            name="summary",
+            field=models.TextField(blank=True),
+        ),
+        migrations.AddField(
+            model_name="thread",
+            name="summary_until",
+            field=models.DateTimeField(blank=True, null=True),
+        ),
+    ]
@@ -27,6 +27,21 @@ class ChatBot(models.Model):
     model_max_length = models.IntegerField()
     output_max_length = models.IntegerField()
 
+    # Retrieved documents with a cosine similarity (0 to 1) below this are left
+    # out of the prompt. Only applies to vector hits, not to full-text matches.
+    context_min_score = models.FloatField(blank=True, null=True)
+
+    # Reuse the answer of a near-identical recent question (see chat.answer_cache)
+    answer_cache = models.BooleanField(default=False)
+    answer_cache_threshold = models.FloatField(default=0.95)
+    answer_cache_ttl = models.IntegerField(default=3600, help_text="Seconds")
+
+    # Older turns of long threads are sent as a rolling summary (see chat.completion)
+    summarize_threads = models.BooleanField(default=False)
+    summary_threshold = models.IntegerField(
+        default=2000, help_text="Tokens of unsummarized history"
+    )
+
     is_public = models.BooleanField()
 
     group = models.ForeignKey("auth.Group", models.CASCADE)
@@ -58,6 +73,10 @@ class Thread(models.Model):
     bot = models.ForeignKey(ChatBot, models.CASCADE)
     uid = models.UUIDField(primary_key=True, default=uuid4)
 
+    # Summary of the messages up to (including) summary_until
+    summary = models.TextField(blank=True)
+    summary_until = models.DateTimeField(blank=True, null=True)
+
     message_set: models.QuerySet["Message"]
     
     def messages(self):
@@ -71,6 +90,40 @@ class Thread(models.Model):
             for message in self.message_set.all().order_by("created_at")
         ]
 
+    def recent_messages(self, limit: int, after=None):
+        """
+        The last user and assistant messages (created after ``after``), oldest first.
+
+        System prompts are left out, each turn builds its own with fresh context.
+        """
+        recent = self.message_set.exclude(role="system")
+        if after is not None:
+            recent = recent.filter(created_at__gt=after)
+        recent = recent.order_by("-created_at").values("role", "content", "created_at")
+        return list(recent[:limit])[::-1]
+
+    def messages_page(self, before=None, limit: int = 50):
+        """
+        A page of the messages before the message with pk ``before`` (or the
+        latest ones), oldest first, and the cursor of the next older page.
+        """
+        messages = self.message_set.exclude(role="system").order_by("-pk")
+        if before is not None:
+            messages = messages.filter(pk__lt=before)
+
+        page = list(messages[: limit + 1])
+        cursor = page[limit - 1].pk if len(page) > limit else None
+        return [
+            {
+                "id": message.pk,
+                "role": message.role,
+                "content": message.content,
+                "tools": json.dumps(message.tools),
+                "created_at": message.created_at,
+            }
+            for message in reversed(page[:limit])
+        ], cursor
+
     def initial_message(self):
         return self.message_set.filter(role="user").first()
 
@@ -92,3 +145,10 @@ class Message(models.Model):
     thread = models.ForeignKey(Thread, models.CASCADE)
 
     tools = models.JSONField(default=dict, blank=True)
+
+    class Meta:
+        indexes = [
+            models.Index(
+                fields=["thread", "created_at"], name="chat_msg_thread_created_idx"
+            )
+        ]
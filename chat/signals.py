@@ -0,0 +1,15 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from chat import bot_cache
+from chat.models import ChatBot, Field
+from context.models import Collection
+
+
+@receiver([post_save, post_delete], sender=ChatBot)
+@receiver([post_save, post_delete], sender=Field)
+@receiver([post_save, post_delete], sender=Collection)
+def forget_bots(sender, **kwargs):
+    # Other processes must not reload the old rows before the change is committed
+    transaction.on_commit(bot_cache.invalidate)
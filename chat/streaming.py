@@ -0,0 +1,91 @@
+"""
+Server-sent events for the streaming variants of the answer endpoints.
+
+A stream sends a ``docs`` event with the retrieved documents, ``token``
+events as the completion arrives and a final ``done`` event with the tools
+(and thread) once the messages are stored.
+"""
+
+import json
+from typing import AsyncIterable, Awaitable, Callable, List
+
+from django.http import StreamingHttpResponse
+from django.utils.encoding import force_str
+
+
+def sse(event: str, data) -> str:
+    return f"event: {event}\ndata: {json.dumps(data, default=force_str)}\n\n"
+
+
+def parse_tool_arguments(arguments: List[str]):
+    if not arguments:
+        return []
+    try:
+        return json.loads(arguments[0])
+    except json.JSONDecodeError:
+        return []
+
+
+async def _tokens(completion: AsyncIterable, arguments: List[str]):
+    """Yields the content deltas, collecting tool call arguments on the side."""
+    async for chunk in completion:
+        if not chunk.choices:
+            continue
+        delta = chunk.choices[0].delta
+
+        for call in delta.tool_calls or []:
+            while len(arguments) <= call.index:
+                arguments.append("")
+            if call.function and call.function.arguments:
+                arguments[call.index] += call.function.arguments
+
+        if delta.content:
+            yield delta.content
+
+
+def stream_answer(
+    docs: list,
+    completion: AsyncIterable,
+    persist: Callable[[str, list], Awaitable[dict]],
+) -> StreamingHttpResponse:
+    """
+    Streams a completion as server-sent events.
+
+    ``persist`` is awaited with the full content and the parsed tools once
+    the completion is done and returns the extra fields of the ``done`` event.
+    """
+
+    async def events():
+        yield sse("docs", docs)
+
+        arguments: List[str] = []
+        parts = []
+        async for token in _tokens(completion, arguments):
+            token = token.replace("ß", "ss")
+            parts.append(token)
+            yield sse("token", token)
+
+        tools = parse_tool_arguments(arguments)
+        extra = await persist("".join(parts), tools)
+        yield sse("done", {"tools": tools, **extra})
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
+
+
+def stream_cached(
+    docs: list, content: str, tools, extra: dict
+) -> StreamingHttpResponse:
+    """Sends a stored answer in the same format as a live stream."""
+
+    async def events():
+        yield sse("docs", docs)
+        yield sse("token", content)
+        yield sse("done", {"tools": tools, **extra})
+
+    response = StreamingHttpResponse(events(), content_type="text/event-stream")
+    response["Cache-Control"] = "no-cache"
+    response["X-Accel-Buffering"] = "no"
+    return response
@@ -0,0 +1,83 @@
+from collections import defaultdict
+from typing import Dict, List, Optional
+
+from celery import shared_task
+from django.conf import settings
+
+from chat.completion import summarize_thread
+from chat.message import store_questions
+from chat.models import ChatBot, Message, Thread
+from context.query_cache import cached_queries
+
+
+@shared_task(
+    autoretry_for=(Exception,),
+    retry_backoff=True,
+    max_retries=5,
+    acks_late=True,
+)
+def store_questions_task(
+    pks: List[int],
+    payloads: Optional[Dict[str, dict]] = None,
+    vectors: Optional[Dict[str, list]] = None,
+):
+    """Stores user messages in the question stores of their bots, per bot in batches."""
+    # Task arguments are JSON, the keys came back as strings
+    payloads = {int(pk): payload for pk, payload in (payloads or {}).items()}
+    vectors = {int(pk): vector for pk, vector in (vectors or {}).items()}
+
+    by_bot = defaultdict(list)
+    for message in Message.objects.filter(pk__in=pks, role="user").select_related(
+        "thread__bot__context_provider"
+    ):
+        by_bot[message.thread.bot].append(message)
+
+    for bot, messages in by_bot.items():
+        store_questions(messages, bot, payloads, vectors)
+
+
+def queue_questions(
+    messages: List[Message],
+    payloads: Optional[Dict[int, dict]] = None,
+    bot: Optional[ChatBot] = None,
+):
+    """
+    Queues user messages for store_questions_task, in batches of
+    QUESTION_INDEX_BATCH_SIZE.
+
+    With the bot, questions the request already embedded (e.g. for the
+    search) are sent along, so the task doesn't embed them again.
+    """
+    pks = [message.pk for message in messages]
+    payloads = payloads or {}
+
+    vectors = {}
+    if bot is not None and bot.context_provider:
+        found = cached_queries(
+            [message.content for message in messages], bot.context_provider
+        )
+        vectors = {
+            message.pk: vector.tolist()
+            for message, vector in zip(messages, found)
+            if vector is not None
+        }
+
+    size = settings.QUESTION_INDEX_BATCH_SIZE
+    for start in range(0, len(pks), size):
+        batch = pks[start : start + size]
+        store_questions_task.delay(
+            batch,
+            {str(pk): payloads[pk] for pk in batch if pk in payloads},
+            {str(pk): vectors[pk] for pk in batch if pk in vectors},
+        )
+
+
+@shared_task(autoretry_for=(Exception,), retry_backoff=True, max_retries=3)
+def summarize_thread_task(pk: str):
+    summarize_thread(Thread.objects.select_related("bot").get(pk=pk))
+
+
+def queue_summary(thread: Thread, bot: ChatBot):
+    """Queues an update of the thread's summary, if the bot uses summaries."""
+    if bot.summarize_threads:
+        summarize_thread_task.delay(str(thread.pk))
@@ -1,3 +1,63 @@
-from django.test import TestCase
+from unittest import mock
 
-# Create your tests here.
+from django.test import SimpleTestCase, override_settings
+
+from chat.completion import pack_documents
+from chat.models import ChatBot
+from context.models import Document
+
+
+def document(content: str, similarity=None) -> Document:
+    doc = Document(content=content, number=0)
+    doc.similarity = similarity
+    return doc
+
+
+def words(text: str, bot: ChatBot) -> int:
+    return len(text.split())
+
+
+@mock.patch("chat.completion.count_tokens", words)
+@override_settings(CONTEXT_MIN_RELATIVE_SCORE=0.0, CONTEXT_DUPLICATE_SIMILARITY=0.9)
+class PackDocumentsTest(SimpleTestCase):
+    def setUp(self):
+        self.bot = ChatBot(model="gpt-4o")
+
+    def test_keeps_the_order(self):
+        docs = [document("first"), document("second"), document("third")]
+
+        self.assertEqual(pack_documents(docs, self.bot, budget=100), docs)
+
+    def test_minimum_similarity(self):
+        self.bot.context_min_score = 0.5
+        docs = [document("close", 0.8), document("far", 0.3)]
+
+        self.assertEqual(pack_documents(docs, self.bot, budget=100), docs[:1])
+
+    @override_settings(CONTEXT_MIN_RELATIVE_SCORE=0.5)
+    def test_relative_similarity(self):
+        docs = [document("best", 0.8), document("good", 0.5), document("weak", 0.3)]
+
+        self.assertEqual(pack_documents(docs, self.bot, budget=100), docs[:2])
+
+    def test_thresholds_skip_documents_without_similarity(self):
+        # e.g. full-text matches, their scores are ranks
+        self.bot.context_min_score = 0.5
+        docs = [document("dense", 0.2), document("lexical")]
+
+        self.assertEqual(pack_documents(docs, self.bot, budget=100), docs[1:])
+
+    def test_skips_near_duplicates(self):
+        docs = [
+            document("opening hours of the town hall"),
+            document("Opening hours of the town hall!"),
+            document("parking near the town hall"),
+        ]
+
+        self.assertEqual(pack_documents(docs, self.bot, budget=100), [docs[0], docs[2]])
+
+    def test_token_budget(self):
+        docs = [document("a b c d e f"), document("g h"), document("i")]
+
+        # Each formatted document has one more "word", its reference
+        self.assertEqual(pack_documents(docs, self.bot, budget=6), docs[1:])
@@ -1,6 +1,7 @@
 from django.urls import path
 
 from chat.views import (
+    answer_stream_view,
     answer_view,
     field_view,
     form_view,
@@ -8,7 +9,9 @@ from chat.views import (
     manage_view,
     manage_chatbot,
     thread_continue,
+    thread_continue_stream,
     thread_init,
+    thread_init_stream,
 )
 
 app_name = "chat"
@@ -17,9 +20,18 @@ urlpatterns = [
     path("detect-language/", determine_language, name="detect-language"),
     path("manage/", manage_view, name="manage"),
     path("<slug:slug>/", answer_view, name="answer"),
+    path("<slug:slug>/stream/", answer_stream_view, name="answer-stream"),
     path("<slug:slug>/fields/", field_view, name="fields"),
     path("<slug:slug>/manage/", manage_chatbot, name="manage-chatbot"),
     path("<slug:slug>/thread/init/", thread_init, name="thread-init"),
+    path(
+        "<slug:slug>/thread/init/stream/", thread_init_stream, name="thread-init-stream"
+    ),
     path("<slug:slug>/thread/", thread_continue, name="thread-continue"),
+    path(
+        "<slug:slug>/thread/stream/",
+        thread_continue_stream,
+        name="thread-continue-stream",
+    ),
     path("", form_view, name="form"),
 ]
@@ -1,16 +1,22 @@
 # Create your views here.
+import asyncio
 import json
 
+from asgiref.sync import sync_to_async
+from django.conf import settings
 from django.contrib.auth.decorators import login_required
 from django.http import HttpRequest, JsonResponse
 from django.shortcuts import render
 from django.views.decorators.csrf import csrf_exempt
 from langdetect import detect
 
-from chat.completion import generate_answer
-from chat.message import store_question
+from chat import answer_cache
+from chat.bot_cache import aget_bot
+from chat.completion import agenerate_answer, thread_history
+from chat.tasks import queue_questions, queue_summary
+from chat.streaming import stream_answer, stream_cached
 from chat.models import ChatBot, Thread, Message
-from context.search import get_documents, search
+from context.search import aget_documents, asearch
 from context.serializers import DocumentSerializer
 
 import requests
@@ -21,49 +27,139 @@ def index_view(request: HttpRequest):
     return render(request, "index.html")
 
 
-@csrf_exempt
-def answer_view(request: HttpRequest, slug):
+async def retrieve(bot: ChatBot, q: str):
+    if not bot.context_provider:
+        return []
+    results = await asearch(bot.context_provider, q, limit=10)
+    return await aget_documents(results)
 
-    data = request.POST.dict()
-    q = str(data.pop("question"))[-10_000:]
 
-    bot = ChatBot.objects.get(slug=slug)
-    docs = []
+async def lookup_or_retrieve(bot: ChatBot, q: str, data: dict):
+    """Runs the answer cache lookup alongside the retrieval, see answer_cache"""
+    if not bot.answer_cache:
+        return None, await retrieve(bot, q)
+    return await asyncio.gather(
+        sync_to_async(answer_cache.lookup)(q, bot, data), retrieve(bot, q)
+    )
 
-    data.pop("csrfmiddlewaretoken", "")
-    if bot.context_provider:
-        results = search(bot.context_provider.slug, q, limit=10)
-        docs = get_documents(results)
 
-    answer, _ = generate_answer(q, bot, docs, **data)
+@sync_to_async
+def serialize_docs(docs):
+    return DocumentSerializer(docs, many=True).data
 
-    message: openai = answer.choices[0].message
-    content = message.content or ""
+
+# Questions are embedded and stored by a background task, see chat.tasks
+aqueue_questions = sync_to_async(queue_questions, thread_sensitive=False)
+aqueue_summary = sync_to_async(queue_summary, thread_sensitive=False)
+
+
+def parse_tools(message):
     tools = message.tool_calls or []
     if len(tools) > 0:
         try:
             tools = json.loads(tools[0].function.arguments)
         except json.JSONDecodeError as er:
             tools = []
+    return tools
+
+
+async def store_cached_answer(bot: ChatBot, q: str, answer: Message):
+    thread = await Thread.objects.acreate(bot=bot)
+    await thread.message_set.acreate(content=q, role="user")
+    await thread.message_set.acreate(
+        content=answer.content, tools=answer.tools, role="assistant"
+    )
+
+
+@csrf_exempt
+async def answer_view(request: HttpRequest, slug):
+
+    data = request.POST.dict()
+    q = str(data.pop("question"))[-10_000:]
+
+    bot = await aget_bot(slug)
+
+    data.pop("csrfmiddlewaretoken", "")
+
+    cached, docs = await lookup_or_retrieve(bot, q, data)
+    if cached is not None:
+        answer, docs = cached
+        await store_cached_answer(bot, q, answer)
+
+        return JsonResponse(
+            {
+                "tools": answer.tools,
+                "answer": answer.content,
+                "docs": await serialize_docs(docs),
+                "cached": True,
+            }
+        )
+
+    answer, _ = await agenerate_answer(q, bot, docs, **data)
+
+    message: openai = answer.choices[0].message
+    content = (message.content or "").replace("ß", "ss")
+    tools = parse_tools(message)
 
-    thread = Thread.objects.create(bot=bot)
-    msg = thread.message_set.create(
+    thread = await Thread.objects.acreate(bot=bot)
+    msg = await thread.message_set.acreate(
         content=q,
         role="user",
     )
-    store_question(msg, bot)
-    thread.message_set.create(
-        content=content.replace("ß", "ss"),
+    reply = await thread.message_set.acreate(
+        content=content,
         tools=tools,
         role="assistant",
     )
-    serializer = DocumentSerializer(docs, many=True)
+    payload = answer_cache.question_payload(bot, data, reply, docs)
+    _, docs_data = await asyncio.gather(
+        aqueue_questions([msg], {msg.pk: payload}, bot), serialize_docs(docs)
+    )
 
     return JsonResponse(
-        {"tools": tools, "answer": content.replace("ß", "ss"), "docs": serializer.data}
+        {
+            "tools": tools,
+            "answer": content,
+            "docs": docs_data,
+            "cached": False,
+        }
     )
 
 
+@csrf_exempt
+async def answer_stream_view(request: HttpRequest, slug):
+    """Streaming variant of answer_view, see chat.streaming"""
+    data = request.POST.dict()
+    q = str(data.pop("question"))[-10_000:]
+
+    bot = await aget_bot(slug)
+
+    data.pop("csrfmiddlewaretoken", "")
+
+    cached, docs = await lookup_or_retrieve(bot, q, data)
+    if cached is not None:
+        answer, docs = cached
+        await store_cached_answer(bot, q, answer)
+        return stream_cached(
+            await serialize_docs(docs), answer.content, answer.tools, {"cached": True}
+        )
+
+    completion, _ = await agenerate_answer(q, bot, docs, stream=True, **data)
+
+    async def persist(content, tools):
+        thread = await Thread.objects.acreate(bot=bot)
+        msg = await thread.message_set.acreate(content=q, role="user")
+        reply = await thread.message_set.acreate(
+            content=content, tools=tools, role="assistant"
+        )
+        await aqueue_questions(
+            [msg], {msg.pk: answer_cache.question_payload(bot, data, reply, docs)}, bot
+        )
+        return {"cached": False}
+
+    return stream_answer(await serialize_docs(docs), completion, persist)
+
+
 @login_required
 def form_view(request):
     groups = request.user.groups.all()
@@ -104,65 +200,73 @@ def manage_chatbot(request, slug):
 
 
 @csrf_exempt
-def thread_init(request, slug):
+async def thread_init(request, slug):
     data = request.POST.dict()
     q = str(data.pop("question"))[-10_000:]
 
-    bot = ChatBot.objects.get(slug=slug)
-    docs = []
+    bot = await aget_bot(slug)
 
     data.pop("csrfmiddlewaretoken", "")
 
-    if bot.context_provider:
-        results = search(bot.context_provider.slug, q, limit=10)
-        docs = get_documents(results)
+    docs = await retrieve(bot, q)
 
-    answer, messages = generate_answer(q, bot, docs, **data)
+    answer, messages = await agenerate_answer(q, bot, docs, **data)
 
     # Init the thread
-    thread = Thread.objects.create(bot=bot)
+    thread = await Thread.objects.acreate(bot=bot)
 
+    questions = []
     for message in messages:
-        msg = thread.message_set.create(
+        msg = await thread.message_set.acreate(
             content=message["content"],
             role=message["role"],
         )
 
         if message["role"] == "user":
-            store_question(msg, bot)
+            questions.append(msg)
 
     message = answer.choices[0].message
-    content = message.content or ""
-    content = content.replace("ß", "ss")
-    tools = message.tool_calls or []
+    content = (message.content or "").replace("ß", "ss")
+    tools = parse_tools(message)
 
-    if len(tools) > 0:
-        try:
-            tools = json.loads(tools[0].function.arguments)
-        except json.JSONDecodeError as er:
-            tools = []
+    await thread.message_set.acreate(content=content, tools=tools, role="assistant")
 
-    thread.message_set.create(content=content, tools=tools, role="assistant")
-
-    serializer = DocumentSerializer(docs, many=True)
+    _, docs_data = await asyncio.gather(
+        aqueue_questions(questions, bot=bot), serialize_docs(docs)
+    )
 
     return JsonResponse(
         {
             "tools": tools,
             "answer": content,
-            "docs": serializer.data,
+            "docs": docs_data,
             "threadId": thread.pk,
         }
     )
 
 
 @csrf_exempt
-def thread_continue(request, slug):
+async def thread_continue(request, slug):
 
     if request.method == "GET":
+        errors = {}
+        page = {}
+        for key, default in (("limit", settings.THREAD_PAGE_SIZE), ("before", None)):
+            try:
+                value = request.GET.get(key)
+                page[key] = int(value) if value else default
+            except ValueError:
+                errors[key] = ["Must be an integer."]
+        if errors:
+            return JsonResponse(errors, status=400)
+
         thread_id = request.GET.get("pk")
-        thread = Thread.objects.get(pk=thread_id)
-        return JsonResponse({"messages": thread.messages()[1:]})
+        thread = await Thread.objects.aget(pk=thread_id)
+        limit = max(1, min(page["limit"], settings.THREAD_PAGE_SIZE))
+        messages, cursor = await sync_to_async(thread.messages_page)(
+            page["before"], limit
+        )
+        return JsonResponse({"messages": messages, "next": cursor})
 
     data = request.POST.dict()
 
@@ -170,44 +274,101 @@ def thread_continue(request, slug):
 
     q = str(data.pop("question"))[-10_000:]
 
-    bot = ChatBot.objects.get(slug=slug)
-    docs = []
+    bot = await aget_bot(slug)
 
-    if bot.context_provider:
-        results = search(bot.context_provider.slug, q, limit=10)
-        docs = get_documents(results)
-
-    thread = Thread.objects.get(pk=data.pop("threadId"))
-    messages = thread.messages()
+    docs, thread = await asyncio.gather(
+        retrieve(bot, q), Thread.objects.aget(pk=data.pop("threadId"))
+    )
+    messages = await sync_to_async(thread_history)(thread, bot)
 
-    answer, messages = generate_answer(q, bot, docs, messages=messages, **data)
+    answer, messages = await agenerate_answer(q, bot, docs, messages=messages, **data)
 
     message = answer.choices[0].message
-    content = message.content or ""
-
-    content = content.replace("ß", "ss")
-    tools = message.tool_calls or []
-
-    if len(tools) > 0:
-        try:
-            tools = json.loads(tools[0].function.arguments)
-        except json.JSONDecodeError as er:
-            tools = []
+    content = (message.content or "").replace("ß", "ss")
+    tools = parse_tools(message)
 
     msg = messages[-1]
 
-    msg = thread.message_set.create(role=msg["role"], content=msg["content"])
-    store_question(msg, bot)
-
-    thread.message_set.create(role="assistant", content=content, tools=tools)
-
-    serializer = DocumentSerializer(docs, many=True)
+    msg = await thread.message_set.acreate(role=msg["role"], content=msg["content"])
+    _, _, docs_data = await asyncio.gather(
+        aqueue_questions([msg], bot=bot),
+        thread.message_set.acreate(role="assistant", content=content, tools=tools),
+        serialize_docs(docs),
+    )
+    await aqueue_summary(thread, bot)
 
     return JsonResponse(
         {
             "tools": tools,
             "answer": content,
-            "docs": serializer.data,
+            "docs": docs_data,
             "threadId": thread.pk,
         }
     )
+
+
+@csrf_exempt
+async def thread_init_stream(request, slug):
+    """Streaming variant of thread_init, see chat.streaming"""
+    data = request.POST.dict()
+    q = str(data.pop("question"))[-10_000:]
+
+    bot = await aget_bot(slug)
+
+    data.pop("csrfmiddlewaretoken", "")
+
+    docs = await retrieve(bot, q)
+
+    completion, messages = await agenerate_answer(q, bot, docs, stream=True, **data)
+
+    async def persist(content, tools):
+        thread = await Thread.objects.acreate(bot=bot)
+
+        questions = []
+        for message in messages:
+            msg = await thread.message_set.acreate(
+                content=message["content"],
+                role=message["role"],
+            )
+
+            if message["role"] == "user":
+                questions.append(msg)
+
+        await thread.message_set.acreate(content=content, tools=tools, role="assistant")
+        await aqueue_questions(questions, bot=bot)
+        return {"threadId": thread.pk}
+
+    return stream_answer(await serialize_docs(docs), completion, persist)
+
+
+@csrf_exempt
+async def thread_continue_stream(request, slug):
+    """Streaming variant of thread_continue, see chat.streaming"""
+    data = request.POST.dict()
+
+    data.pop("csrfmiddlewaretoken", "")
+
+    q = str(data.pop("question"))[-10_000:]
+
+    bot = await aget_bot(slug)
+
+    docs, thread = await asyncio.gather(
+        retrieve(bot, q), Thread.objects.aget(pk=data.pop("threadId"))
+    )
+    messages = await sync_to_async(thread_history)(thread, bot)
+
+    completion, messages = await agenerate_answer(
+        q, bot, docs, messages=messages, stream=True, **data
+    )
+
+    async def persist(content, tools):
+        msg = messages[-1]
+        msg = await thread.message_set.acreate(role=msg["role"], content=msg["content"])
+        await asyncio.gather(
+            aqueue_questions([msg], bot=bot),
+            thread.message_set.acreate(role="assistant", content=content, tools=tools),
+        )
+        await aqueue_summary(thread, bot)
+        return {"threadId": thread.pk}
+
+    return stream_answer(await serialize_docs(docs), completion, persist)
@@ -3,6 +3,7 @@
 
 from typing import Any
 from django.contrib import admin
+from django.db import transaction
 from django.db.models.query import QuerySet
 from django.forms.models import ModelForm
 from django.http import HttpRequest
@@ -28,6 +29,21 @@ class CollectionAdmin(admin.ModelAdmin):
         for q in queryset:
             reindex_documents_task.delay(pk=q.pk)
 
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+
+        # Vectors of a different model or size can't be mixed and vectors don't move
+        # between backends by themselves, rebuild the collection
+        embedding_fields = {
+            "use_openai",
+            "language",
+            "embedding_model",
+            "embedding_dimensions",
+            "vector_backend",
+        }
+        if change and embedding_fields & set(form.changed_data):
+            transaction.on_commit(lambda: reindex_documents_task.delay(pk=obj.pk))
+
     def get_queryset(self, request: HttpRequest) -> QuerySet:
         qs = super().get_queryset(request)
         if request.user.is_superuser:
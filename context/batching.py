@@ -0,0 +1,187 @@
+"""Token-aware, concurrent batching of OpenAI embedding requests."""
+
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+import numpy as np
+import openai
+import tiktoken
+from django.conf import settings
+
+# Limit of a single input for the text-embedding-3 models
+MAX_INPUT_TOKENS = 8191
+# Limit of inputs per request
+MAX_BATCH_INPUTS = 2048
+
+_encoding = None
+
+
+def _tokenizer():
+    global _encoding
+    if _encoding is None:
+        _encoding = tiktoken.get_encoding("cl100k_base")
+    return _encoding
+
+
+class TokenBudget:
+    """Token bucket shared by all embedding requests of the process."""
+
+    def __init__(self, tokens_per_minute: int):
+        self.capacity = tokens_per_minute
+        self.rate = tokens_per_minute / 60
+        self.available = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens: int):
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.available = min(
+                    self.capacity, self.available + (now - self.updated) * self.rate
+                )
+                self.updated = now
+                if self.available >= tokens:
+                    self.available -= tokens
+                    return
+                wait = (tokens - self.available) / self.rate
+            time.sleep(wait)
+
+
+_budget_lock = threading.Lock()
+_budget: Optional[TokenBudget] = None
+
+
+def token_budget() -> TokenBudget:
+    global _budget
+    with _budget_lock:
+        if _budget is None:
+            _budget = TokenBudget(settings.OPENAI_EMBEDDING_TPM)
+        return _budget
+
+
+# (position in the input, text, number of tokens)
+Item = Tuple[int, str, int]
+
+
+def prepare(texts: List[str]) -> List[Item]:
+    """Counts the tokens of every text, truncating those over the input limit."""
+    encoding = _tokenizer()
+    items = []
+    for i, text in enumerate(texts):
+        tokens = encoding.encode(text, disallowed_special=())
+        if len(tokens) > MAX_INPUT_TOKENS:
+            tokens = tokens[:MAX_INPUT_TOKENS]
+            text = encoding.decode(tokens)
+        items.append((i, text, len(tokens)))
+    return items
+
+
+def pack(items: List[Item], max_tokens: int) -> List[List[Item]]:
+    """Groups items into requests of at most max_tokens tokens, keeping their order."""
+    batches: List[List[Item]] = []
+    batch: List[Item] = []
+    tokens = 0
+    for item in items:
+        if batch and (tokens + item[2] > max_tokens or len(batch) >= MAX_BATCH_INPUTS):
+            batches.append(batch)
+            batch, tokens = [], 0
+        batch.append(item)
+        tokens += item[2]
+    if batch:
+        batches.append(batch)
+    return batches
+
+
+def _retry_after(ex: Exception, attempt: int) -> float:
+    response = getattr(ex, "response", None)
+    if response is not None:
+        value = response.headers.get("retry-after")
+        try:
+            return float(value)
+        except (TypeError, ValueError):
+            pass
+    return min(2**attempt, 60)
+
+
+def _request(client: openai.Client, batch: List[Item], model: str, **kwargs):
+    retries = settings.OPENAI_EMBEDDING_RETRIES
+    for attempt in range(retries + 1):
+        token_budget().acquire(sum(item[2] for item in batch))
+        try:
+            response = client.embeddings.create(
+                input=[item[1] for item in batch], model=model, **kwargs
+            )
+            return [
+                data.embedding for data in sorted(response.data, key=lambda d: d.index)
+            ]
+        except (
+            openai.RateLimitError,
+            openai.APIConnectionError,
+            openai.InternalServerError,
+        ) as ex:
+            if attempt == retries:
+                raise
+            time.sleep(_retry_after(ex, attempt))
+
+
+# Error codes and messages of requests rejected for their size
+SIZE_ERROR_CODES = {"context_length_exceeded", "max_tokens_per_request"}
+SIZE_ERROR_MESSAGES = (
+    "maximum context length",
+    "tokens per request",
+    "too many tokens",
+    "too long",
+)
+
+
+def _too_large(ex: openai.BadRequestError) -> bool:
+    if ex.code in SIZE_ERROR_CODES:
+        return True
+    message = str(ex).lower()
+    return any(text in message for text in SIZE_ERROR_MESSAGES)
+
+
+def _embed_batch(client: openai.Client, batch: List[Item], model: str, **kwargs):
+    """Embeds a batch, splitting it in halves if the API rejects it as too large."""
+    try:
+        embeddings = _request(client, batch, model, **kwargs)
+    except openai.BadRequestError as ex:
+        # Other bad requests (unknown model, invalid dimensions, ...) fail the
+        # same way for every half
+        if len(batch) == 1 or not _too_large(ex):
+            raise
+        middle = len(batch) // 2
+        return _embed_batch(client, batch[:middle], model, **kwargs) + _embed_batch(
+            client, batch[middle:], model, **kwargs
+        )
+    return list(zip((item[0] for item in batch), embeddings))
+
+
+def embed(client: openai.Client, texts: List[str], model: str, **kwargs):
+    """
+    Returns the embeddings of texts, in input order.
+
+    Texts are packed into requests by token count, which are sent
+    concurrently within the configured tokens-per-minute budget.
+    """
+    batches = pack(prepare(texts), settings.OPENAI_EMBEDDING_BATCH_TOKENS)
+
+    if len(batches) == 1:
+        results = [_embed_batch(client, batches[0], model, **kwargs)]
+    else:
+        with ThreadPoolExecutor(settings.OPENAI_EMBEDDING_CONCURRENCY) as executor:
+            results = list(
+                executor.map(
+                    lambda batch: _embed_batch(client, batch, model, **kwargs), batches
+                )
+            )
+
+    embeddings: List = [None] * len(texts)
+    for result in results:
+        for i, embedding in result:
+            embeddings[i] = embedding
+    return np.array(embeddings)
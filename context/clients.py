@@ -0,0 +1,89 @@
+"""
+Shared OpenAI-compatible clients, one per (base_url, api key).
+
+Clients keep their connection pool for the lifetime of the process, so
+requests to a provider reuse open connections instead of repeating the TLS
+handshake. Sync clients are shared by all threads and recreated after a
+fork; async clients are bound to the event loop they were created on.
+"""
+
+import asyncio
+import os
+import threading
+import weakref
+from typing import Dict, Optional, Tuple
+
+import httpx
+import openai
+from django.conf import settings
+
+_lock = threading.Lock()
+_clients: Dict[Tuple[str, str], openai.OpenAI] = {}
+_clients_pid: Optional[int] = None
+
+# Async clients by event loop (they are bound to it) and key
+_async_clients: "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, dict]" = (
+    weakref.WeakKeyDictionary()
+)
+
+
+def _key(base_url: str, api_key: Optional[str]) -> Tuple[str, str]:
+    return base_url or "", api_key if api_key is not None else settings.OPENAI_KEY
+
+
+def _options() -> dict:
+    return dict(
+        timeout=httpx.Timeout(
+            settings.LLM_TIMEOUT, connect=settings.LLM_CONNECT_TIMEOUT
+        ),
+        max_retries=settings.LLM_MAX_RETRIES,
+    )
+
+
+def _limits() -> httpx.Limits:
+    return httpx.Limits(
+        max_connections=settings.LLM_MAX_CONNECTIONS,
+        max_keepalive_connections=settings.LLM_MAX_KEEPALIVE_CONNECTIONS,
+        keepalive_expiry=settings.LLM_KEEPALIVE_EXPIRY,
+    )
+
+
+def openai_client(base_url: str = "", api_key: Optional[str] = None) -> openai.OpenAI:
+    """Returns the shared client of a provider, OpenAI by default."""
+    global _clients_pid
+    key = _key(base_url, api_key)
+
+    with _lock:
+        if _clients_pid != os.getpid():
+            _clients.clear()
+            _clients_pid = os.getpid()
+
+        client = _clients.get(key)
+        if client is None:
+            client = openai.OpenAI(
+                api_key=key[1],
+                base_url=key[0] or None,
+                http_client=openai.DefaultHttpxClient(limits=_limits()),
+                **_options(),
+            )
+            _clients[key] = client
+        return client
+
+
+def async_openai_client(
+    base_url: str = "", api_key: Optional[str] = None
+) -> openai.AsyncOpenAI:
+    """Returns the shared async client of a provider for the running event loop."""
+    key = _key(base_url, api_key)
+
+    clients = _async_clients.setdefault(asyncio.get_running_loop(), {})
+    client = clients.get(key)
+    if client is None:
+        client = openai.AsyncOpenAI(
+            api_key=key[1],
+            base_url=key[0] or None,
+            http_client=openai.DefaultAsyncHttpxClient(limits=_limits()),
+            **_options(),
+        )
+        clients[key] = client
+    return client
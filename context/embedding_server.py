@@ -0,0 +1,154 @@
+"""
+Local embedding server that owns the LASER encoders of all workers.
+
+Run it with ``python manage.py embedding_server`` and point
+EMBEDDING_SERVER_ADDRESS at it (a unix socket path or host:port). Single
+requests arriving within EMBEDDING_SERVER_BATCH_WINDOW seconds are encoded
+together.
+"""
+
+import os
+import queue
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Client, Connection, Listener
+from typing import Dict, List, Tuple
+
+import numpy as np
+from django.conf import settings
+
+
+def server_address():
+    address = settings.EMBEDDING_SERVER_ADDRESS
+    if address.startswith("/"):
+        return address
+    host, port = address.rsplit(":", 1)
+    return host, int(port)
+
+
+def _authkey() -> bytes:
+    return settings.SECRET_KEY.encode()
+
+
+_local = threading.local()
+
+
+def request_embeddings(texts: List[str], language: str) -> np.ndarray:
+    """Encodes texts on the embedding server, reusing a connection per thread."""
+    for attempt in range(2):
+        connection = getattr(_local, "connection", None)
+        if connection is None:
+            connection = Client(server_address(), authkey=_authkey())
+            _local.connection = connection
+        try:
+            connection.send((language, texts))
+            status, result = connection.recv()
+            break
+        except (EOFError, OSError):
+            # The server restarted, reconnect once
+            _local.connection = None
+            connection.close()
+            if attempt == 1:
+                raise
+
+    if status != "ok":
+        raise RuntimeError(f"Embedding server failed: {result}")
+    return result
+
+
+class MicroBatcher:
+    """Collects requests for one language and encodes them in batches."""
+
+    def __init__(self, language: str):
+        self.language = language
+        self.requests: "queue.Queue[Tuple[List[str], Future]]" = queue.Queue()
+        threading.Thread(target=self._run, daemon=True).start()
+
+    def submit(self, texts: List[str]) -> Future:
+        future: Future = Future()
+        self.requests.put((texts, future))
+        return future
+
+    def _collect(self):
+        pending = [self.requests.get()]
+        count = len(pending[0][0])
+        deadline = time.monotonic() + settings.EMBEDDING_SERVER_BATCH_WINDOW
+
+        while count < settings.EMBEDDING_SERVER_MAX_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                request = self.requests.get(timeout=timeout)
+            except queue.Empty:
+                break
+            pending.append(request)
+            count += len(request[0])
+        return pending
+
+    def _run(self):
+        from context.embeddings import encode_local
+
+        while True:
+            pending = self._collect()
+            texts = [text for request_texts, _ in pending for text in request_texts]
+
+            try:
+                embeddings = encode_local(texts, self.language)
+            except Exception as ex:
+                for _, future in pending:
+                    future.set_exception(ex)
+                continue
+
+            offset = 0
+            for request_texts, future in pending:
+                future.set_result(embeddings[offset : offset + len(request_texts)])
+                offset += len(request_texts)
+
+
+_batchers: Dict[str, MicroBatcher] = {}
+_batchers_lock = threading.Lock()
+
+
+def batcher(language: str) -> MicroBatcher:
+    with _batchers_lock:
+        if language not in _batchers:
+            _batchers[language] = MicroBatcher(language)
+        return _batchers[language]
+
+
+def _handle(connection: Connection):
+    with connection:
+        while True:
+            try:
+                language, texts = connection.recv()
+            except EOFError:
+                return
+
+            try:
+                connection.send(("ok", batcher(language).submit(texts).result()))
+            except Exception as ex:
+                connection.send(("error", repr(ex)))
+
+
+def serve():
+    from context.embeddings import load_encoder
+
+    for language in settings.LASER_WARMUP_LANGUAGES:
+        load_encoder(language)
+
+    address = server_address()
+    if isinstance(address, str) and os.path.exists(address):
+        # Left over from a previous run
+        os.unlink(address)
+
+    with Listener(address, authkey=_authkey()) as listener:
+        print(f"Embedding server listening on {settings.EMBEDDING_SERVER_ADDRESS}")
+        while True:
+            try:
+                connection = listener.accept()
+            except Exception as ex:
+                print("Rejected connection:", ex)
+                continue
+            threading.Thread(target=_handle, args=(connection,), daemon=True).start()
@@ -1,115 +1,758 @@
+import asyncio
+import os
+import queue
+import re
+import threading
+import weakref
 from contextlib import contextmanager
-from typing import List, TYPE_CHECKING
+from datetime import timedelta
+from functools import partial
+from hashlib import sha1
+from typing import Dict, List, NamedTuple, Optional, Tuple, TYPE_CHECKING
 
 import numpy as np
-import openai
+from cachetools import LRUCache, TTLCache
+from django import db
 from django.conf import settings
-from django.db.models import QuerySet
-from qdrant_client import QdrantClient, models
+from django.db.models import Q, QuerySet
+from django.utils import timezone
+from qdrant_client import AsyncQdrantClient, QdrantClient, models
 
 if TYPE_CHECKING:
     from laser_encoders import LaserEncoderPipeline
 
-from context.models import Collection, Document
+from context import batching, embedding_server
+from context.clients import openai_client
+from context.models import (
+    OPENAI_EMBEDDING_DIMENSIONS,
+    CachedEmbedding,
+    Collection,
+    Document,
+)
+from context.vector_index import LocalIndex
+
+_qdrant_lock = threading.Lock()
+_qdrant: Optional[QdrantClient] = None
+_qdrant_pid: Optional[int] = None
+
+# Vector params of collections known to exist, by name
+_collections: TTLCache = TTLCache(maxsize=1024, ttl=5 * 60)
+
+
+def get_qdrant() -> QdrantClient:
+    """
+    Returns the Qdrant client of this process.
+
+    The client (and its connection pool) is shared by all threads and kept
+    open for the lifetime of the process. A new one is created after a fork,
+    e.g. in celery worker children.
+    """
+    global _qdrant, _qdrant_pid
+    with _qdrant_lock:
+        if _qdrant is None or _qdrant_pid != os.getpid():
+            _qdrant = QdrantClient(
+                settings.QDRANT_HOST,
+                port=settings.QDRANT_PORT,
+                grpc_port=settings.QDRANT_GRPC_PORT,
+                prefer_grpc=settings.QDRANT_PREFER_GRPC,
+                timeout=settings.QDRANT_TIMEOUT,
+            )
+            _qdrant_pid = os.getpid()
+            _collections.clear()
+        return _qdrant
 
 
 @contextmanager
 def qdrant_client():
-    client = QdrantClient(settings.QDRANT_HOST, port=settings.QDRANT_PORT)
+    yield get_qdrant()
 
-    try:
-        yield client
-    finally:
-        client.close()
 
+# Async clients are bound to the event loop they were created on
+_async_qdrant: (
+    "weakref.WeakKeyDictionary[asyncio.AbstractEventLoop, AsyncQdrantClient]"
+) = weakref.WeakKeyDictionary()
 
-def load_encoder(language):
-    from laser_encoders import LaserEncoderPipeline
 
-    encoder = LaserEncoderPipeline(language)
-    return encoder
+def get_async_qdrant() -> AsyncQdrantClient:
+    """Returns the async Qdrant client of the running event loop."""
+    loop = asyncio.get_running_loop()
+    client = _async_qdrant.get(loop)
+    if client is None:
+        client = AsyncQdrantClient(
+            settings.QDRANT_HOST,
+            port=settings.QDRANT_PORT,
+            grpc_port=settings.QDRANT_GRPC_PORT,
+            prefer_grpc=settings.QDRANT_PREFER_GRPC,
+            timeout=settings.QDRANT_TIMEOUT,
+        )
+        _async_qdrant[loop] = client
+    return client
+
+
+_encoder_lock = threading.Lock()
+_encoders: Optional["LRUCache[str, LaserEncoderPipeline]"] = None
+# Held while a language's model loads, so it loads once without blocking others
+_loading_locks: Dict[str, threading.Lock] = {}
+
+
+def _encoder_cache() -> "LRUCache[str, LaserEncoderPipeline]":
+    global _encoders
+    if _encoders is None:
+        _encoders = LRUCache(maxsize=settings.LASER_ENCODER_CACHE_SIZE)
+    return _encoders
+
+
+def load_encoder(language) -> "LaserEncoderPipeline":
+    """
+    Returns the LASER encoder for the given language.
+
+    Encoders are kept in a per-process LRU registry, so the model is only
+    loaded the first time a language is used (or after it was evicted).
+    """
+    with _encoder_lock:
+        encoder = _encoder_cache().get(language)
+        if encoder is not None:
+            return encoder
+        loading = _loading_locks.setdefault(language, threading.Lock())
+
+    with loading:
+        with _encoder_lock:
+            encoder = _encoder_cache().get(language)
+        if encoder is None:
+            from laser_encoders import LaserEncoderPipeline
+
+            encoder = LaserEncoderPipeline(language)
+            with _encoder_lock:
+                _encoder_cache()[language] = encoder
+        return encoder
+
+
+def warm_up_encoders(languages: Optional[List[str]] = None):
+    """Loads the encoders for the configured languages into the registry."""
+    if settings.EMBEDDING_SERVER_ADDRESS:
+        # The encoders live in the embedding server
+        return
+
+    if languages is None:
+        languages = settings.LASER_WARMUP_LANGUAGES
+
+    for language in languages:
+        load_encoder(language)
 
 
 EMBEDDING_DIMENSION = 1024
 
+OPENAI_EMBEDDING_MODEL = "text-embedding-3-large"
 
-def generate_embeddings(texts: List[str], encoder):
+
+def encode_local(texts: List[str], language: str):
+    encoder = load_encoder(language)
     return np.array(encoder.encode_sentences(texts, normalize_embeddings=True))
 
 
-def generate_embeddings_openai(texts: List[str]):
-    client = openai.Client(api_key=settings.OPENAI_KEY)
-    response = client.embeddings.create(input=texts, model="text-embedding-3-large")
-    results = [data.embedding for data in response.data]
-    client.close()
-    return np.array(results)
+def generate_embeddings(texts: List[str], language: str):
+    """Encodes texts with LASER, on the embedding server if one is configured."""
+    if settings.EMBEDDING_SERVER_ADDRESS:
+        return embedding_server.request_embeddings(texts, language)
+    return encode_local(texts, language)
+
 
+def generate_embeddings_openai(
+    texts: List[str],
+    model: str = OPENAI_EMBEDDING_MODEL,
+    dimensions: Optional[int] = None,
+):
+    kwargs = {}
+    if dimensions:
+        # The text-embedding-3 models return shortened (still normalized) vectors
+        kwargs["dimensions"] = dimensions
 
-def get_embedding(document: Document):
-    if document.collection.use_openai:
-        return generate_embeddings_openai([document.content])
+    # Retries are handled by the batcher, which honors Retry-After
+    client = openai_client().with_options(max_retries=0)
+    return batching.embed(client, texts, model, **kwargs)
 
-    return generate_embeddings(
-        [document.content], load_encoder(document.collection.language)
+
+class EmbeddingConfig(NamedTuple):
+    # "openai:<model>" or "laser:<language>"
+    model: str
+    dimension: int
+
+
+def configured_embedding(collection: Collection) -> EmbeddingConfig:
+    """The embedding the collection's fields ask for, applied by the next rebuild."""
+    if not collection.use_openai:
+        return EmbeddingConfig(f"laser:{collection.language}", EMBEDDING_DIMENSION)
+    return EmbeddingConfig(
+        f"openai:{collection.embedding_model}",
+        collection.embedding_dimensions
+        or OPENAI_EMBEDDING_DIMENSIONS[collection.embedding_model],
     )
 
 
-def batch_qs(qs, batch_size=1000):
+def live_embedding(collection: Collection) -> EmbeddingConfig:
+    """The embedding the live vectors were built with, see Collection.indexed_embedding."""
+    if collection.indexed_embedding:
+        return EmbeddingConfig(
+            collection.indexed_embedding, collection.indexed_dimension
+        )
+    return configured_embedding(collection)
+
+
+def embedding_model(collection: Collection) -> str:
+    """Identifies the model that produces the (live) embeddings of a collection."""
+    return live_embedding(collection).model
+
+
+def embedding_dimension(collection: Collection) -> int:
+    return live_embedding(collection).dimension
+
+
+def embed_with(texts: List[str], config: EmbeddingConfig):
+    provider, name = config.model.split(":", 1)
+    if provider == "openai":
+        dimensions = config.dimension
+        if dimensions == OPENAI_EMBEDDING_DIMENSIONS.get(name):
+            dimensions = None
+        return generate_embeddings_openai(texts, name, dimensions)
+    return generate_embeddings(texts, name)
+
+
+def embed_texts(
+    texts: List[str], collection: Collection, config: Optional[EmbeddingConfig] = None
+):
+    """Embeds texts like the live vectors of the collection, or with the given config."""
+    return embed_with(texts, config or live_embedding(collection))
+
+
+def content_hash(content: str) -> str:
+    return sha1(content.encode()).hexdigest()
+
+
+def embed_documents(
+    contents: List[str],
+    collection: Collection,
+    config: Optional[EmbeddingConfig] = None,
+):
     """
-    Returns a (start, end, total, queryset) tuple for each batch in the given
-    queryset.
+    Returns the embeddings of document contents (for the live vectors by default).
 
-    Usage:
-        # Make sure to order your querset
-        article_qs = Article.objects.order_by('id')
-        for start, end, total, qs in batch_qs(article_qs):
-            print "Now processing %s - %s of %s" % (start + 1, end, total)
-            for article in qs:
-                print article.body
+    Embeddings are looked up in the CachedEmbedding table first, only the
+    chunks that were never embedded with the collection's model are sent
+    to the encoder. Vectors are stored as float16.
+
+    The cache key is the hash of the content embedded here, not
+    Document.content_hash, which can be stale for documents edited before it
+    was kept in sync.
     """
-    total = qs.count()
-    for start in range(0, total, batch_size):
-        end = min(start + batch_size, total)
-        yield qs[start:end]
+    config = config or live_embedding(collection)
+    model, dimension = config
+    hashes = [content_hash(content) for content in contents]
+
+    vectors = {
+        cached.content_hash: np.frombuffer(cached.vector, dtype=np.float16)
+        for cached in CachedEmbedding.objects.filter(
+            model=model, dimension=dimension, content_hash__in=set(hashes)
+        )
+    }
+
+    missing = {}
+    for h, content in zip(hashes, contents):
+        if h not in vectors:
+            missing[h] = content
+
+    if missing:
+        print(f"Creating embeddings for {len(missing)} of {len(contents)} texts")
+        embeddings = embed_with(list(missing.values()), config)
+        compact = [np.asarray(e, dtype=np.float16) for e in embeddings]
+
+        CachedEmbedding.objects.bulk_create(
+            [
+                CachedEmbedding(
+                    content_hash=h,
+                    model=model,
+                    dimension=dimension,
+                    vector=vector.tobytes(),
+                )
+                for h, vector in zip(missing, compact)
+            ],
+            ignore_conflicts=True,
+        )
+        vectors.update(zip(missing, compact))
+
+    return np.array([vectors[h] for h in hashes], dtype=np.float32)
+
+
+def get_embedding(document: Document, config: Optional[EmbeddingConfig] = None):
+    return embed_documents([document.content], document.collection, config)
+
+
+def keyset_batches(qs, batch_size=1000):
+    """
+    Yields lists of rows from a values_list queryset whose first column is
+    the pk, ordered by pk.
+
+    Uses keyset pagination (pk > last pk) instead of OFFSET, so batches stay
+    cheap deep into large tables and rows changing while we iterate (e.g.
+    is_indexed being set) do not shift the following batches.
+    """
+    last_pk = None
+    while True:
+        batch = qs if last_pk is None else qs.filter(pk__gt=last_pk)
+        rows = list(batch.order_by("pk")[:batch_size])
+        if not rows:
+            return
+        yield rows
+        last_pk = rows[-1][0]
 
 
 def names(response):
     return [collection.name for collection in response.collections]
 
 
+def get_alias(qdrant, alias) -> Optional[str]:
+    """Returns the name of the collection an alias points to, if it exists."""
+    for description in qdrant.get_aliases().aliases:
+        if description.alias_name == alias:
+            return description.collection_name
+    return None
+
+
+def collection_params(qdrant, slug) -> Optional[models.VectorParams]:
+    """
+    Returns the vector params of a collection or alias, or None if it does
+    not exist.
+
+    Only existing collections are cached, so a collection created by another
+    process is picked up on the next call.
+    """
+    with _qdrant_lock:
+        params = _collections.get(slug)
+    if params is not None:
+        return params
+
+    name = slug
+    if slug not in names(qdrant.get_collections()):
+        name = get_alias(qdrant, slug)
+        if name is None:
+            return None
+
+    params = qdrant.get_collection(name).config.params.vectors
+    with _qdrant_lock:
+        _collections[slug] = params
+    return params
+
+
 def collection_exists(qdrant, slug):
-    return slug in names(qdrant.get_collections())
+    return collection_params(qdrant, slug) is not None
 
 
-def _batch_insert(collection, query, encoder, use_openai):
-    records = list(query)
-    print(f"Creating embeddings for {len(records)} texts")
+def forget_collection(slug):
+    with _qdrant_lock:
+        _collections.pop(slug, None)
 
-    if use_openai:
-        embeddings = generate_embeddings_openai([r[1] for r in records])
-    else:
-        embeddings = generate_embeddings([r[1] for r in records], encoder)
 
-    embedding_dim = embeddings.shape[-1]
+def create_collection(qdrant, slug, vectors_config, **kwargs):
+    qdrant.create_collection(slug, vectors_config, **kwargs)
+    forget_collection(slug)
 
-    with qdrant_client() as qdrant:
-        if not collection_exists(qdrant, collection.slug):
-            qdrant.create_collection(
-                collection.slug,
-                models.VectorParams(
-                    size=embedding_dim, distance=models.Distance.COSINE
+
+def delete_collection(qdrant, slug):
+    qdrant.delete_collection(slug)
+    forget_collection(slug)
+
+
+def collection_version(collection: Collection) -> str:
+    # Slugs can't contain dots, so no version is ever another collection's name
+    return f"{collection.slug}.v{timezone.now():%Y%m%d%H%M%S%f}"
+
+
+def _is_version(collection: Collection, name: str) -> bool:
+    return re.fullmatch(rf"{re.escape(collection.slug)}\.v\d+", name) is not None
+
+
+def write_targets(
+    collection: Collection,
+) -> List[Tuple[Optional[str], EmbeddingConfig]]:
+    """
+    Where document writes go, with the embedding to use: the live collection
+    and the version reindex_documents is building, if any (read from the
+    database, the instance may be older than the rebuild).
+    """
+    current = (
+        Collection.objects.filter(pk=collection.pk)
+        .values(
+            "indexed_embedding",
+            "indexed_dimension",
+            "building_version",
+            "building_embedding",
+            "building_dimension",
+        )
+        .first()
+    )
+    if current is None:
+        return [(None, live_embedding(collection))]
+
+    live = live_embedding(collection)
+    if current["indexed_embedding"]:
+        live = EmbeddingConfig(
+            current["indexed_embedding"], current["indexed_dimension"]
+        )
+
+    targets = [(None, live)]
+    if current["building_version"]:
+        targets.append(
+            (
+                current["building_version"],
+                EmbeddingConfig(
+                    current["building_embedding"], current["building_dimension"]
                 ),
             )
+        )
+    return targets
+
+
+def _record_build(collection: Collection, **fields):
+    for field, value in fields.items():
+        setattr(collection, field, value)
+    # A save, so the signals see the new embedding (e.g. cached bots)
+    collection.save(update_fields=list(fields))
+
+
+def point_alias(qdrant, alias: str, target: str):
+    """
+    Atomically points an alias to target.
+
+    A plain Qdrant collection with the same name (from before collections
+    were versioned) is removed first, since it would shadow the alias.
+    """
+    if alias in names(qdrant.get_collections()):
+        qdrant.delete_collection(alias)
+
+    operations = []
+    if get_alias(qdrant, alias) is not None:
+        operations.append(
+            models.DeleteAliasOperation(
+                delete_alias=models.DeleteAlias(alias_name=alias)
+            )
+        )
+    operations.append(
+        models.CreateAliasOperation(
+            create_alias=models.CreateAlias(collection_name=target, alias_name=alias)
+        )
+    )
+    qdrant.update_collection_aliases(change_aliases_operations=operations)
+    forget_collection(alias)
+
+
+def switch_alias(qdrant, collection: Collection, target: str, config: EmbeddingConfig):
+    """
+    Points the alias named after the collection to target, whose vectors
+    were built with config. From here on queries and writes use config.
+    """
+    point_alias(qdrant, collection.slug, target)
+    _record_build(
+        collection,
+        indexed_embedding=config.model,
+        indexed_dimension=config.dimension,
+        indexed_backend="qdrant",
+    )
+
+
+def quantization_config(collection: Collection):
+    if collection.quantization == "scalar":
+        return models.ScalarQuantization(
+            scalar=models.ScalarQuantizationConfig(
+                type=models.ScalarType.INT8, quantile=0.99, always_ram=True
+            )
+        )
+    if collection.quantization == "binary":
+        return models.BinaryQuantization(
+            binary=models.BinaryQuantizationConfig(always_ram=True)
+        )
+    return None
+
+
+def hnsw_config(collection: Collection):
+    if collection.hnsw_m is None and collection.hnsw_ef_construct is None:
+        return None
+    return models.HnswConfigDiff(
+        m=collection.hnsw_m, ef_construct=collection.hnsw_ef_construct
+    )
+
+
+def search_params(collection: Collection, ef: Optional[int] = None):
+    quantization = None
+    if collection.quantization:
+        quantization = models.QuantizationSearchParams(
+            rescore=collection.quantization_rescore,
+            oversampling=collection.quantization_oversampling,
+        )
+    return models.SearchParams(
+        hnsw_ef=ef or collection.search_ef, quantization=quantization
+    )
 
-        qdrant.upload_records(
-            collection_name=collection.slug,
-            records=[
-                models.Record(id=r[0], vector=embedding)
-                for r, embedding in zip(records, embeddings)
+
+# Payload fields that can be filtered on, with their index type
+PAYLOAD_INDEXES = {
+    "domain": models.PayloadSchemaType.KEYWORD,
+    "page": models.PayloadSchemaType.INTEGER,
+    "file": models.PayloadSchemaType.INTEGER,
+    "published_at": models.PayloadSchemaType.DATETIME,
+}
+
+# Document columns read for the payload, in the order of document_payload's arguments
+PAYLOAD_COLUMNS = (
+    "title",
+    "number",
+    "page_id",
+    "file_id",
+    "page__domain",
+    "page__published_at",
+)
+
+
+def document_payload(
+    collection: Collection, title, number, page_id, file_id, domain, published_at
+):
+    return {
+        "collection": collection.slug,
+        "title": title,
+        "number": number,
+        "page": page_id,
+        "file": file_id,
+        "domain": domain,
+        "published_at": published_at.isoformat() if published_at else None,
+    }
+
+
+def payload_of(doc: Document):
+    return document_payload(
+        doc.collection,
+        doc.title,
+        doc.number,
+        doc.page_id,
+        doc.file_id,
+        doc.page.domain if doc.page else None,
+        doc.page.published_at if doc.page else None,
+    )
+
+
+def qdrant_filter(filters: Optional[dict]) -> Optional[models.Filter]:
+    """
+    Translates search filters to a Qdrant filter.
+
+    Supported keys: domain (one or a list), page, file, published_after and
+    published_before.
+    """
+    if not filters:
+        return None
+
+    conditions = []
+    if filters.get("domain"):
+        domains = filters["domain"]
+        if isinstance(domains, str):
+            domains = [domains]
+        conditions.append(
+            models.FieldCondition(key="domain", match=models.MatchAny(any=domains))
+        )
+    for key in ("page", "file"):
+        if filters.get(key) is not None:
+            conditions.append(
+                models.FieldCondition(
+                    key=key, match=models.MatchValue(value=int(filters[key]))
+                )
+            )
+    if filters.get("published_after") or filters.get("published_before"):
+        conditions.append(
+            models.FieldCondition(
+                key="published_at",
+                range=models.DatetimeRange(
+                    gte=filters.get("published_after"),
+                    lte=filters.get("published_before"),
+                ),
+            )
+        )
+    return models.Filter(must=conditions)
+
+
+def document_filter(filters: Optional[dict]) -> dict:
+    """Translates search filters to lookups on Document."""
+    lookups = {}
+    if not filters:
+        return lookups
+
+    if filters.get("domain"):
+        domains = filters["domain"]
+        lookups["page__domain__in"] = [domains] if isinstance(domains, str) else domains
+    if filters.get("page") is not None:
+        lookups["page_id"] = filters["page"]
+    if filters.get("file") is not None:
+        lookups["file_id"] = filters["file"]
+    if filters.get("published_after"):
+        lookups["page__published_at__gte"] = filters["published_after"]
+    if filters.get("published_before"):
+        lookups["page__published_at__lte"] = filters["published_before"]
+    return lookups
+
+
+def create_document_collection(
+    qdrant, collection: Collection, name: str, embedding_dim: int
+):
+    """Creates a Qdrant collection with the storage options of the collection."""
+    create_collection(
+        qdrant,
+        name,
+        models.VectorParams(
+            size=embedding_dim,
+            distance=models.Distance.COSINE,
+            on_disk=collection.vectors_on_disk or None,
+        ),
+        hnsw_config=hnsw_config(collection),
+        quantization_config=quantization_config(collection),
+    )
+    for field, schema in PAYLOAD_INDEXES.items():
+        qdrant.create_payload_index(name, field_name=field, field_schema=schema)
+
+
+def ensure_collection(qdrant, collection: Collection, embedding_dim: int):
+    """
+    Creates the Qdrant collection for a collection if it does not exist yet,
+    as a first version the collection's alias points to.
+    """
+    if collection_exists(qdrant, collection.slug):
+        return
+
+    target = collection_version(collection)
+    create_document_collection(qdrant, collection, target, embedding_dim)
+    switch_alias(qdrant, collection, target, live_embedding(collection))
+
+
+def configured_backend(collection: Optional[Collection]) -> str:
+    """The vector backend the collection asks for, applied by the next rebuild."""
+    backend = collection.vector_backend if collection else ""
+    return backend or settings.VECTOR_BACKEND
+
+
+def uses_local_index(
+    collection: Optional[Collection], target: Optional[str] = None
+) -> bool:
+    """
+    Whether vectors are kept in a local file index instead of Qdrant.
+
+    For the live vectors this is the backend they were built in (see
+    Collection.indexed_backend), a version being built is local if its file
+    exists.
+    """
+    if target:
+        return LocalIndex(target).exists()
+    if collection is not None and collection.indexed_backend:
+        return collection.indexed_backend == "local"
+    return configured_backend(collection) == "local"
+
+
+def store_vectors(
+    collection: Collection,
+    pks,
+    embeddings,
+    payloads=None,
+    target: Optional[str] = None,
+    wait=True,
+):
+    """
+    Writes document vectors to the collection's vector backend.
+
+    Payloads are only stored in Qdrant, the local index filters through the
+    database instead. A target version is never created here, writes to a
+    version that is gone (e.g. a failed rebuild) are skipped.
+    """
+    name = target or collection.slug
+
+    if uses_local_index(collection, target):
+        index = LocalIndex(name)
+        if not target and index.ensure(embeddings.shape[-1]):
+            config = live_embedding(collection)
+            _record_build(
+                collection,
+                indexed_embedding=config.model,
+                indexed_dimension=config.dimension,
+                indexed_backend="local",
+            )
+        index.upsert(pks, embeddings)
+        return
+
+    with qdrant_client() as qdrant:
+        if target:
+            if not collection_exists(qdrant, target):
+                return
+        else:
+            ensure_collection(qdrant, collection, embeddings.shape[-1])
+        qdrant.upload_points(
+            collection_name=name,
+            points=[
+                models.PointStruct(id=pk, vector=embedding.tolist(), payload=payload)
+                for pk, embedding, payload in zip(
+                    pks, embeddings, payloads or [None] * len(pks)
+                )
             ],
+            wait=wait,
+        )
+
+
+def _embed_batch(collection: Collection, targets, item):
+    records, last = item
+    contents = [r[1] for r in records]
+    embeddings = {
+        config: embed_documents(contents, collection, config)
+        for config in {config for _, config in targets}
+    }
+    payloads = [document_payload(collection, *r[2:]) for r in records]
+    return [r[0] for r in records], embeddings, payloads, last
+
+
+def _upload_batch(collection: Collection, targets, batch):
+    pks, embeddings, payloads, last = batch
+
+    # Updates are applied in order, waiting for the last one waits for all
+    for target, config in targets:
+        store_vectors(collection, pks, embeddings[config], payloads, target, wait=last)
+
+    # Only the live collection counts, a version being built may still fail
+    if any(target is None for target, _ in targets):
+        Document.objects.filter(pk__in=pks).update(
+            is_indexed=True, indexed_at=timezone.now()
         )
 
 
+_DONE = object()
+
+
+def _run_stage(func, inbox: queue.Queue, outbox: Optional[queue.Queue], errors):
+    """
+    Applies func to every item of inbox and passes the result on to outbox.
+
+    After a failure the stage keeps draining its inbox (so upstream stages
+    never block on a full queue) but stops doing work.
+    """
+    try:
+        while True:
+            item = inbox.get()
+            if item is _DONE:
+                break
+            if errors:
+                continue
+            try:
+                result = func(item)
+            except Exception as ex:
+                errors.append(ex)
+                continue
+            if outbox is not None:
+                outbox.put(result)
+    finally:
+        if outbox is not None:
+            outbox.put(_DONE)
+        db.connection.close()
+
+
 def index_documents(collection: Collection):
 
     query = Document.objects.filter(collection=collection).filter(is_indexed=False)
@@ -118,40 +761,260 @@ def index_documents(collection: Collection):
 
 
 def insert_document(doc: Document):
-    with qdrant_client() as client:
-        client.upsert(
-            doc.collection.slug,
-            [models.PointStruct(id=doc.pk, vector=get_embedding(doc)[0])],
+    for target, config in write_targets(doc.collection):
+        store_vectors(
+            doc.collection,
+            [doc.pk],
+            get_embedding(doc, config),
+            [payload_of(doc)],
+            target,
         )
 
 
 def update_document(doc: Document):
-    with qdrant_client() as client:
-        client.update_vectors(
-            doc.collection.slug,
-            [models.PointVectors(id=doc.pk, vector=get_embedding(doc)[0])],
-        )
+    insert_document(doc)
 
 
-def update_documents(docs: QuerySet[Document], collection: Collection):
-    if not collection.use_openai:
-        encoder = load_encoder(collection.language)
-    else:
-        encoder = None
+def update_documents(
+    docs: QuerySet[Document],
+    collection: Collection,
+    batch_size=1000,
+    target: Optional[Tuple[str, EmbeddingConfig]] = None,
+):
+    """
+    Embeds and uploads documents in a three stage pipeline.
+
+    Batches are read here, embedded in one thread and uploaded in another,
+    connected by bounded queues. So the next batch is read and embedded while
+    the previous one is uploaded. Each batch is marked as indexed as soon as
+    it is uploaded.
+
+    Points go to the live collection (through its alias), and to the
+    version being built during a rebuild, unless a target (version and
+    its embedding) is given. The upload of the last batch waits until all
+    batches are applied.
+    """
+    targets = [target] if target else write_targets(collection)
+
+    to_embed: queue.Queue = queue.Queue(maxsize=settings.INDEXING_QUEUE_SIZE)
+    to_upload: queue.Queue = queue.Queue(maxsize=settings.INDEXING_QUEUE_SIZE)
+    errors: List[Exception] = []
+
+    stages = [
+        threading.Thread(
+            target=_run_stage,
+            args=(
+                partial(_embed_batch, collection, targets),
+                to_embed,
+                to_upload,
+                errors,
+            ),
+        ),
+        threading.Thread(
+            target=_run_stage,
+            args=(
+                partial(_upload_batch, collection, targets),
+                to_upload,
+                None,
+                errors,
+            ),
+        ),
+    ]
+    for stage in stages:
+        stage.start()
 
-    for batch in batch_qs(docs.values_list("pk", "content").order_by("pk")):
-        _batch_insert(collection, batch, encoder, collection.use_openai)
+    try:
+        rows = docs.values_list("pk", "content", *PAYLOAD_COLUMNS)
+        batches = keyset_batches(rows, batch_size)
+        batch = next(batches, None)
+        while batch is not None and not errors:
+            print(f"Indexing documents {batch[0][0]} - {batch[-1][0]}")
+            following = next(batches, None)
+            to_embed.put((batch, following is None))
+            batch = following
+    finally:
+        to_embed.put(_DONE)
+        for stage in stages:
+            stage.join()
 
-    docs.update(is_indexed=True)
+    if errors:
+        raise errors[0]
 
 
 def reindex_documents(collection: Collection):
+    """
+    Rebuilds the vectors of a collection without downtime.
+
+    All documents are indexed into a new version of the Qdrant collection,
+    with the collection's configured embedding, while searches keep using
+    the current one. Writes during the rebuild go to both. Documents changed
+    or deleted while the new version was built are caught up afterwards,
+    then the alias is switched to the new version (and its embedding) and
+    older versions are deleted.
+
+    Only one rebuild of a collection runs at a time, see RebuildInProgress.
+    """
+    target = collection_version(collection)
+    config = configured_embedding(collection)
+
+    previous = "local" if uses_local_index(collection) else "qdrant"
+
+    _claim_build(collection, target, config)
+    try:
+        if configured_backend(collection) == "local":
+            _reindex_local(collection, target, config)
+        else:
+            _reindex_qdrant(collection, target, config)
+    finally:
+        _release_build(collection, target)
+
+    if previous != configured_backend(collection):
+        _drop_backend(collection, previous)
+
+
+class RebuildInProgress(Exception):
+    """Another rebuild of the collection is running, retry once it is done."""
+
+
+def _claim_build(collection: Collection, target: str, config: EmbeddingConfig):
+    """
+    Records the version being built, unless another rebuild is running.
+
+    Version names sort by their start time, so a build started more than
+    REINDEX_STALE_AFTER ago (e.g. by a worker that was killed) is taken over.
+    """
+    cutoff = timezone.now() - timedelta(seconds=settings.REINDEX_STALE_AFTER)
+    stale = f"{collection.slug}.v{cutoff:%Y%m%d%H%M%S%f}"
+    claimed = (
+        Collection.objects.filter(pk=collection.pk)
+        .filter(Q(building_version="") | Q(building_version__lt=stale))
+        .update(
+            building_version=target,
+            building_embedding=config.model,
+            building_dimension=config.dimension,
+        )
+    )
+    if not claimed:
+        raise RebuildInProgress(collection.slug)
+
+    collection.building_version = target
+    collection.building_embedding = config.model
+    collection.building_dimension = config.dimension
+
+
+def _release_build(collection: Collection, target: str):
+    # Unless a rebuild took over in the meantime
+    Collection.objects.filter(pk=collection.pk, building_version=target).update(
+        building_version=""
+    )
+    collection.building_version = ""
+
+
+def _reindex_qdrant(collection: Collection, target: str, config: EmbeddingConfig):
+    with qdrant_client() as qdrant:
+        create_document_collection(qdrant, collection, target, config.dimension)
+
+    try:
+        _build_version(collection, target, config)
+    except Exception:
+        with qdrant_client() as qdrant:
+            delete_collection(qdrant, target)
+        raise
+
+    with qdrant_client() as qdrant:
+        switch_alias(qdrant, collection, target, config)
+
+        # Only versions older than this one, a newer rebuild may have taken over
+        for name in names(qdrant.get_collections()):
+            if _is_version(collection, name) and name < target:
+                delete_collection(qdrant, name)
+
+
+def _build_version(collection: Collection, target: str, config: EmbeddingConfig):
+    started = timezone.now()
+
+    docs = Document.objects.filter(collection=collection)
+    update_documents(docs, collection, target=(target, config))
+
+    # The pipeline may have read these before they changed
+    update_documents(
+        docs.filter(updated_at__gte=started), collection, target=(target, config)
+    )
+    _delete_missing(collection, target)
+
+
+def _delete_missing(collection: Collection, target: str):
+    """Deletes the points of documents deleted while the version was built."""
+    existing = set(
+        Document.objects.filter(collection=collection).values_list("pk", flat=True)
+    )
+
+    if uses_local_index(collection, target):
+        index = LocalIndex(target)
+        index.delete([int(pk) for pk in index.rows()["id"] if pk not in existing])
+        return
+
     with qdrant_client() as qdrant:
-        if collection_exists(qdrant, collection.slug):
-            qdrant.delete_collection(collection.slug)
+        deleted = []
+        offset = None
+        while True:
+            points, offset = qdrant.scroll(
+                target,
+                limit=10_000,
+                offset=offset,
+                with_payload=False,
+                with_vectors=False,
+            )
+            deleted += [point.id for point in points if point.id not in existing]
+            if offset is None:
+                break
 
-    Document.objects.filter(collection=collection).update(is_indexed=False)
-    index_documents(collection)
+        if deleted:
+            qdrant.delete(
+                collection_name=target,
+                points_selector=models.PointIdsList(points=deleted),
+                wait=True,
+            )
+
+
+def _reindex_local(collection: Collection, target: str, config: EmbeddingConfig):
+    building = LocalIndex(target)
+    building.create(config.dimension)
+
+    try:
+        _build_version(collection, target, config)
+    except Exception:
+        building.drop()
+        raise
+
+    LocalIndex(collection.slug).replace_with(building)
+    _record_build(
+        collection,
+        indexed_embedding=config.model,
+        indexed_dimension=config.dimension,
+        indexed_backend="local",
+    )
+
+
+def _drop_backend(collection: Collection, backend: str):
+    """Deletes the vectors left in the backend a rebuild moved the collection away from."""
+    if backend == "local":
+        LocalIndex(collection.slug).drop()
+        return
+
+    with qdrant_client() as qdrant:
+        if get_alias(qdrant, collection.slug) is not None:
+            qdrant.update_collection_aliases(
+                change_aliases_operations=[
+                    models.DeleteAliasOperation(
+                        delete_alias=models.DeleteAlias(alias_name=collection.slug)
+                    )
+                ]
+            )
+        for name in names(qdrant.get_collections()):
+            if name == collection.slug or _is_version(collection, name):
+                delete_collection(qdrant, name)
+        forget_collection(collection.slug)
 
 
 def delete_documents(queryset: QuerySet[Document]):
@@ -161,12 +1024,55 @@ def delete_documents(queryset: QuerySet[Document]):
     pks = list(indexed.values_list("pk", flat=True))
     collection = indexed[0].collection
 
-    with qdrant_client() as client:
-        client.delete(
-            collection_name=collection.slug,
-            points_selector=models.PointIdsList(
-                points=pks,
-            ),
-        )
+    for target, _ in write_targets(collection):
+        _delete_points(collection, target, pks=pks)
 
     queryset.delete()
+
+
+def delete_vectors(collection: Collection, filters: dict):
+    """
+    Deletes the vectors of all documents matching the filters.
+
+    With Qdrant this is a single delete by payload filter, which only
+    matches points indexed with payloads (reindex older collections once).
+    Filters without any condition (e.g. an empty domain list) are refused,
+    they would match every vector of the collection.
+    """
+    if not document_filter(filters):
+        raise ValueError(f"No condition in the filters {filters!r}")
+
+    for target, _ in write_targets(collection):
+        _delete_points(collection, target, filters=filters)
+
+
+def _delete_points(
+    collection: Collection,
+    target: Optional[str],
+    pks: Optional[List[int]] = None,
+    filters: Optional[dict] = None,
+):
+    """Deletes points by id or by search filters, see delete_documents and delete_vectors."""
+    name = target or collection.slug
+
+    if uses_local_index(collection, target):
+        index = LocalIndex(name)
+        if not index.exists():
+            return
+        if pks is None:
+            pks = list(
+                Document.objects.filter(
+                    collection=collection, **document_filter(filters)
+                ).values_list("pk", flat=True)
+            )
+        index.delete(pks)
+        return
+
+    with qdrant_client() as client:
+        if target and not collection_exists(client, target):
+            return
+        if pks is not None:
+            selector = models.PointIdsList(points=pks)
+        else:
+            selector = models.FilterSelector(filter=qdrant_filter(filters))
+        client.delete(collection_name=name, points_selector=selector)
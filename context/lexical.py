@@ -0,0 +1,77 @@
+"""Lexical (full-text) retrieval over Document.content."""
+
+import re
+from typing import List, NamedTuple, Optional
+
+from django.conf import settings
+from django.contrib.postgres.search import SearchQuery, SearchRank, SearchVector
+from django.db import connection
+from django.db.models import Q
+
+from context.embeddings import document_filter
+from context.models import Collection, Document
+
+
+class RankHit(NamedTuple):
+    """A hit scored by rank (ts_rank, match count or RRF), not by similarity."""
+
+    id: int
+    score: float
+    # Cosine similarity of the dense hit it was fused from, if any
+    similarity: Optional[float] = None
+
+
+# Must match the expression of the GIN index created in migration 0014
+SEARCH_VECTOR = SearchVector("content", config="simple")
+
+
+def terms(query: str) -> List[str]:
+    return re.findall(r"\w+", query.lower())
+
+
+def is_keyword_query(query: str) -> bool:
+    """Short queries without a question, e.g. product names or article numbers."""
+    words = terms(query)
+    is_question = query.strip().endswith("?")
+    return 0 < len(words) <= settings.LEXICAL_MAX_TERMS and not is_question
+
+
+def lexical_search(
+    collection: Collection, query: str, limit=5, filters: Optional[dict] = None
+) -> List[RankHit]:
+    """Returns documents matching any term of the query, best matches first."""
+    words = terms(query)
+    if not words:
+        return []
+
+    docs = Document.objects.filter(collection=collection, **document_filter(filters))
+
+    if connection.vendor != "postgresql":
+        return _lexical_search_fallback(docs, words, limit)
+
+    search_query = SearchQuery(
+        " | ".join(f"'{word}'" for word in words), config="simple", search_type="raw"
+    )
+    docs = (
+        docs.annotate(
+            search=SEARCH_VECTOR, rank=SearchRank(SEARCH_VECTOR, search_query)
+        )
+        .filter(search=search_query)
+        .order_by("-rank")
+        .values_list("pk", "rank")[:limit]
+    )
+    return [RankHit(pk, rank) for pk, rank in docs]
+
+
+def _lexical_search_fallback(docs, words: List[str], limit: int) -> List[RankHit]:
+    """Substring matching for databases without full-text search (e.g. sqlite)."""
+    match = Q()
+    for word in words:
+        match |= Q(content__icontains=word)
+
+    candidates = docs.filter(match).values_list("pk", "content")[: limit * 10]
+    hits = [
+        RankHit(pk, sum(content.lower().count(word) for word in words))
+        for pk, content in candidates
+    ]
+    return sorted(hits, key=lambda hit: hit.score, reverse=True)[:limit]
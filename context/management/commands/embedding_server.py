@@ -0,0 +1,10 @@
+from django.core.management.base import BaseCommand
+
+from context.embedding_server import serve
+
+
+class Command(BaseCommand):
+    help = "Runs the local embedding server that owns the LASER encoders"
+
+    def handle(self, *args, **options):
+        serve()
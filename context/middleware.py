@@ -0,0 +1,22 @@
+from asgiref.sync import iscoroutinefunction
+from django.utils.decorators import sync_and_async_middleware
+
+from context.query_cache import embedding_scope
+
+
+@sync_and_async_middleware
+def embedding_scope_middleware(get_response):
+    """Shares query embeddings between everything a request embeds, see context.query_cache."""
+    if iscoroutinefunction(get_response):
+
+        async def middleware(request):
+            with embedding_scope():
+                return await get_response(request)
+
+    else:
+
+        def middleware(request):
+            with embedding_scope():
+                return get_response(request)
+
+    return middleware
@@ -0,0 +1,56 @@
+# Generated by Django 5.1.1 on 2026-10-18 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("context", "0010_cachedembedding"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="quantization",
+            field=models.CharField(
+                blank=True,
+                choices=[
+                    ("", "None"),
+                    ("scalar", "Scalar (int8)"),
+                    ("binary", "Binary"),
+                ],
+                max_length=20,
+            ),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="quantization_rescore",
+            field=models.BooleanField(default=True),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="quantization_oversampling",
+            field=models.FloatField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="vectors_on_disk",
+            field=models.BooleanField(default=False),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="hnsw_m",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="hnsw_ef_construct",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="search_ef",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.1.1 on 2026-10-18 11:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("context", "0011_collection_vector_storage"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="embedding_model",
+            field=models.CharField(
+                choices=[
+                    ("text-embedding-3-large", "text-embedding-3-large"),
+                    ("text-embedding-3-small", "text-embedding-3-small"),
+                ],
+                default="text-embedding-3-large",
+                max_length=100,
+            ),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="embedding_dimensions",
+            field=models.IntegerField(blank=True, null=True),
+        ),
+    ]
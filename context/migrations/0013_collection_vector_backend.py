@@ -0,0 +1,22 @@
+# Generated by Django 5.1.1 on 2026-10-18 12:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("context", "0012_collection_embedding_model"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="vector_backend",
+            field=models.CharField(
+                blank=True,
+                choices=[("", "Default"), ("qdrant", "Qdrant"), ("local", "Local file")],
+                max_length=20,
+            ),
+        ),
+    ]
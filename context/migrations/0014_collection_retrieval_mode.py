@@ -0,0 +1,47 @@
+# Generated by Django 5.1.1 on 2026-10-18 13:00
+
+from django.contrib.postgres.indexes import GinIndex
+from django.contrib.postgres.search import SearchVector
+from django.db import migrations, models
+
+INDEX_NAME = "context_document_content_fts"
+
+
+def create_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    Document = apps.get_model("context", "Document")
+    schema_editor.add_index(
+        Document,
+        GinIndex(SearchVector("content", config="simple"), name=INDEX_NAME),
+    )
+
+
+def drop_search_index(apps, schema_editor):
+    if schema_editor.connection.vendor != "postgresql":
+        return
+    Document = apps.get_model("context", "Document")
+    schema_editor.remove_index(
+        Document,
+        GinIndex(SearchVector("content", config="simple"), name=INDEX_NAME),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("context", "0013_collection_vector_backend"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="retrieval_mode",
+            field=models.CharField(
+                choices=[("dense", "Dense"), ("hybrid", "Hybrid"), ("auto", "Auto")],
+                default="dense",
+                max_length=20,
+            ),
+        ),
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
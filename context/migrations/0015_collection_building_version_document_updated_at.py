@@ -0,0 +1,27 @@
+# Generated by Django 5.1.1 on 2026-10-18 19:00
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("context", "0014_collection_retrieval_mode"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="building_version",
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name="document",
+            name="updated_at",
+            field=models.DateTimeField(
+                auto_now=True, default=django.utils.timezone.now
+            ),
+            preserve_default=False,
+        ),
+    ]
@@ -0,0 +1,57 @@
+# Generated by Django 5.1.1 on 2026-10-18 20:00
+
+from django.db import migrations, models
+
+LASER_DIMENSION = 1024
+
+OPENAI_EMBEDDING_DIMENSIONS = {
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+}
+
+
+def record_indexed_embedding(apps, schema_editor):
+    """Existing vectors were built with the configuration saved so far."""
+    Collection = apps.get_model("context", "Collection")
+    for collection in Collection.objects.all():
+        if collection.use_openai:
+            collection.indexed_embedding = f"openai:{collection.embedding_model}"
+            collection.indexed_dimension = (
+                collection.embedding_dimensions
+                or OPENAI_EMBEDDING_DIMENSIONS[collection.embedding_model]
+            )
+        else:
+            collection.indexed_embedding = f"laser:{collection.language}"
+            collection.indexed_dimension = LASER_DIMENSION
+        collection.save(update_fields=["indexed_embedding", "indexed_dimension"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("context", "0015_collection_building_version_document_updated_at"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="indexed_embedding",
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="indexed_dimension",
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="building_embedding",
+            field=models.CharField(blank=True, editable=False, max_length=200),
+        ),
+        migrations.AddField(
+            model_name="collection",
+            name="building_dimension",
+            field=models.IntegerField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(record_indexed_embedding, migrations.RunPython.noop),
+    ]
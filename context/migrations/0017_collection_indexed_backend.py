@@ -0,0 +1,30 @@
+# Generated by Django 5.1.1 on 2026-10-18 21:00
+
+from django.conf import settings
+from django.db import migrations, models
+
+
+def record_indexed_backend(apps, schema_editor):
+    """Existing vectors are in the backend configured so far."""
+    Collection = apps.get_model("context", "Collection")
+    for collection in Collection.objects.all():
+        collection.indexed_backend = (
+            collection.vector_backend or settings.VECTOR_BACKEND
+        )
+        collection.save(update_fields=["indexed_backend"])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("context", "0016_collection_indexed_embedding"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="collection",
+            name="indexed_backend",
+            field=models.CharField(blank=True, editable=False, max_length=20),
+        ),
+        migrations.RunPython(record_indexed_backend, migrations.RunPython.noop),
+    ]
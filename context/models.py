@@ -1,8 +1,16 @@
+from django.core.exceptions import ValidationError
 from django.db import models
 from django.utils import timezone
 
 # Create your models here.
 
+# Full dimensionality of the OpenAI embedding models
+OPENAI_EMBEDDING_DIMENSIONS = {
+    "text-embedding-3-large": 3072,
+    "text-embedding-3-small": 1536,
+    "text-embedding-ada-002": 1536,
+}
+
 
 class Collection(models.Model):
     slug = models.SlugField(unique=True, primary_key=True)
@@ -13,8 +21,73 @@ class Collection(models.Model):
 
     use_openai = models.BooleanField(default=True)
 
+    # OpenAI embedding model, optionally shortened to fewer dimensions
+    embedding_model = models.CharField(
+        max_length=100,
+        default="text-embedding-3-large",
+        choices=[
+            ("text-embedding-3-large", "text-embedding-3-large"),
+            ("text-embedding-3-small", "text-embedding-3-small"),
+        ],
+    )
+    embedding_dimensions = models.IntegerField(blank=True, null=True)
+
     require_auth = models.BooleanField(default=False)
 
+    # dense: vectors only, hybrid: vectors fused with full-text search,
+    # auto: like hybrid, but keyword-like queries are answered by full-text search alone
+    retrieval_mode = models.CharField(
+        max_length=20,
+        default="dense",
+        choices=[("dense", "Dense"), ("hybrid", "Hybrid"), ("auto", "Auto")],
+    )
+
+    # Where vectors are stored, empty uses the VECTOR_BACKEND setting
+    vector_backend = models.CharField(
+        max_length=20,
+        blank=True,
+        choices=[("", "Default"), ("qdrant", "Qdrant"), ("local", "Local file")],
+    )
+
+    # Vector storage, applied when the Qdrant collection is (re)built
+    quantization = models.CharField(
+        max_length=20,
+        blank=True,
+        choices=[("", "None"), ("scalar", "Scalar (int8)"), ("binary", "Binary")],
+    )
+    quantization_rescore = models.BooleanField(default=True)
+    quantization_oversampling = models.FloatField(blank=True, null=True)
+    vectors_on_disk = models.BooleanField(default=False)
+    hnsw_m = models.IntegerField(blank=True, null=True)
+    hnsw_ef_construct = models.IntegerField(blank=True, null=True)
+
+    # Default size of the candidate list at search time
+    search_ef = models.IntegerField(blank=True, null=True)
+
+    # Embedding model ("openai:<model>" or "laser:<language>") and size of the
+    # vectors the live collection was built with. Queries and writes use these,
+    # changes to the fields above apply once reindex_documents switched over.
+    indexed_embedding = models.CharField(max_length=200, blank=True, editable=False)
+    indexed_dimension = models.IntegerField(blank=True, null=True, editable=False)
+    # Backend ("qdrant" or "local") the live vectors are in, changes to
+    # vector_backend apply once reindex_documents moved them
+    indexed_backend = models.CharField(max_length=20, blank=True, editable=False)
+
+    # Vector collection being rebuilt by reindex_documents (and the embedding
+    # it is built with), receives writes too
+    building_version = models.CharField(max_length=200, blank=True, editable=False)
+    building_embedding = models.CharField(max_length=200, blank=True, editable=False)
+    building_dimension = models.IntegerField(blank=True, null=True, editable=False)
+
+    def clean(self):
+        if self.embedding_dimensions is None:
+            return
+        maximum = OPENAI_EMBEDDING_DIMENSIONS[self.embedding_model]
+        if not 0 < self.embedding_dimensions <= maximum:
+            raise ValidationError(
+                {"embedding_dimensions": f"Must be between 1 and {maximum}."}
+            )
+
     def __str__(self) -> str:
         return self.slug
 
@@ -37,6 +110,7 @@ class Document(models.Model):
     is_indexed = models.BooleanField(default=False)
     indexed_at = models.DateTimeField(blank=True, null=True)
     fetched_at = models.DateTimeField(auto_now_add=True)
+    updated_at = models.DateTimeField(auto_now=True)
 
     collection = models.ForeignKey(Collection, models.CASCADE)
 
@@ -51,5 +125,26 @@ class Document(models.Model):
         return super().__str__()
 
 
+class CachedEmbedding(models.Model):
+    """Embedding of a chunk, addressed by its content hash and the model that produced it."""
+
+    content_hash = models.CharField(max_length=60)
+    model = models.CharField(max_length=200)
+    dimension = models.IntegerField()
+
+    # float16 values, see context.embeddings.embed_documents
+    vector = models.BinaryField()
+
+    created_at = models.DateTimeField(auto_now_add=True)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["content_hash", "model", "dimension"],
+                name="unique_cached_embedding",
+            )
+        ]
+
+
 class DocumentMeta(models.Model):
     date = models.DateTimeField(default=timezone.now)
@@ -0,0 +1,181 @@
+"""
+Cache of query embeddings used by the search path.
+
+Within an embedding scope (one per request, see context.middleware) each
+query is embedded at most once, even when the search, the answer cache and
+the question store ask for it concurrently.
+"""
+
+import threading
+from collections import Counter
+from concurrent.futures import Future
+from contextlib import contextmanager
+from contextvars import ContextVar
+from hashlib import sha1
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from cachetools import TTLCache
+from django.conf import settings
+from django.core.cache import caches
+
+from context.embeddings import embed_texts, embedding_dimension, embedding_model
+from context.models import Collection
+
+_lock = threading.Lock()
+_local: Optional[TTLCache] = None
+
+stats: Counter = Counter()
+
+
+def _local_cache() -> TTLCache:
+    global _local
+    if _local is None:
+        _local = TTLCache(
+            maxsize=settings.QUERY_EMBEDDING_CACHE_SIZE,
+            ttl=settings.QUERY_EMBEDDING_CACHE_TTL,
+        )
+    return _local
+
+
+def normalize_query(query: str) -> str:
+    return " ".join(query.split()).lower()
+
+
+def cache_key(query: str, collection: Collection) -> str:
+    model = embedding_model(collection)
+    dimension = embedding_dimension(collection)
+    digest = sha1(f"{model}|{dimension}|{normalize_query(query)}".encode())
+    return f"query-embedding:{digest.hexdigest()}"
+
+
+def _shared_cache():
+    if not settings.QUERY_EMBEDDING_SHARED_CACHE:
+        return None
+    return caches[settings.QUERY_EMBEDDING_SHARED_CACHE]
+
+
+class EmbeddingScope:
+    """The query embeddings of one request, by cache key."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._futures: Dict[str, Future] = {}
+
+    def claim(self, keys: List[str]) -> Tuple[List[str], Dict[str, Future]]:
+        """Returns the keys the caller has to embed, and the futures of all keys."""
+        with self._lock:
+            claimed = [key for key in dict.fromkeys(keys) if key not in self._futures]
+            for key in claimed:
+                self._futures[key] = Future()
+            return claimed, {key: self._futures[key] for key in keys}
+
+    def get(self, key: str) -> Optional[np.ndarray]:
+        """The embedding of a key if it was embedded successfully, without waiting."""
+        with self._lock:
+            future = self._futures.get(key)
+        if future is None or not future.done() or future.exception() is not None:
+            return None
+        return future.result()
+
+
+_scope: ContextVar[Optional[EmbeddingScope]] = ContextVar(
+    "query_embedding_scope", default=None
+)
+
+
+@contextmanager
+def embedding_scope():
+    token = _scope.set(EmbeddingScope())
+    try:
+        yield
+    finally:
+        _scope.reset(token)
+
+
+def embed_queries(queries: List[str], collection: Collection) -> List[np.ndarray]:
+    """
+    Returns the embeddings of search queries.
+
+    Looks in the in-process cache first, then in the shared Django cache
+    (if QUERY_EMBEDDING_SHARED_CACHE names one) and embeds the queries
+    missing in both in a single call.
+    """
+    keys = [cache_key(query, collection) for query in queries]
+
+    scope = _scope.get()
+    if scope is None:
+        return _embed_queries(keys, queries, collection)
+
+    claimed, futures = scope.claim(keys)
+    if claimed:
+        queries_by_key = dict(zip(keys, queries))
+        try:
+            vectors = _embed_queries(
+                claimed, [queries_by_key[key] for key in claimed], collection
+            )
+        except BaseException as ex:
+            for key in claimed:
+                futures[key].set_exception(ex)
+            raise
+        for key, vector in zip(claimed, vectors):
+            futures[key].set_result(vector)
+
+    return [futures[key].result() for key in keys]
+
+
+def cached_queries(
+    queries: List[str], collection: Collection
+) -> List[Optional[np.ndarray]]:
+    """
+    Returns the embeddings of queries already embedded in this request or
+    process, None for the others. Never embeds.
+    """
+    scope = _scope.get()
+    vectors = []
+    for key in [cache_key(query, collection) for query in queries]:
+        vector = scope.get(key) if scope is not None else None
+        if vector is None:
+            with _lock:
+                vector = _local_cache().get(key)
+        vectors.append(vector)
+    return vectors
+
+
+def _embed_queries(
+    keys: List[str], queries: List[str], collection: Collection
+) -> List[np.ndarray]:
+    vectors: Dict[str, np.ndarray] = {}
+
+    with _lock:
+        local = _local_cache()
+        for key in keys:
+            vector = local.get(key)
+            if vector is not None:
+                vectors[key] = vector
+    stats["local_hits"] += len(vectors)
+
+    shared = _shared_cache()
+    if shared is not None and len(vectors) < len(set(keys)):
+        found = shared.get_many([key for key in keys if key not in vectors])
+        stats["shared_hits"] += len(found)
+        with _lock:
+            _local_cache().update(found)
+        vectors.update(found)
+
+    missing = {}
+    for key, query in zip(keys, queries):
+        if key not in vectors:
+            missing[key] = query
+
+    if missing:
+        stats["misses"] += len(missing)
+        embedded = dict(zip(missing, embed_texts(list(missing.values()), collection)))
+
+        with _lock:
+            _local_cache().update(embedded)
+        if shared is not None:
+            shared.set_many(embedded, timeout=settings.QUERY_EMBEDDING_CACHE_TTL)
+        vectors.update(embedded)
+
+    return [vectors[key] for key in keys]
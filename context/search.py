@@ -1,30 +1,295 @@
+import asyncio
+from copy import copy
+from typing import Dict, List, Optional
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import caches
+from qdrant_client import models
+
 from context.embeddings import (
-    generate_embeddings,
-    generate_embeddings_openai,
-    load_encoder,
+    document_filter,
+    get_async_qdrant,
     qdrant_client,
+    qdrant_filter,
+    search_params,
+    uses_local_index,
 )
+from context.lexical import RankHit, is_keyword_query, lexical_search
 from context.models import Collection, Document
+from context.query_cache import embed_queries
+from context.vector_index import LocalIndex
+
+# Bump when the cached document shape changes
+DOCUMENT_CACHE_VERSION = 1
+
+
+# Constant of reciprocal rank fusion, dampens the weight of the top ranks
+RRF_K = 60
+
+
+def fuse(rankings, limit: int) -> List[RankHit]:
+    """Merges rankings by reciprocal rank fusion, keeping the similarity of dense hits."""
+    scores: Dict[int, float] = {}
+    similarities: Dict[int, float] = {}
+    for ranking in rankings:
+        for rank, hit in enumerate(ranking):
+            scores[hit.id] = scores.get(hit.id, 0.0) + 1 / (RRF_K + rank + 1)
+            if not isinstance(hit, RankHit):
+                similarities[hit.id] = hit.score
+
+    fused = sorted(scores.items(), key=lambda item: item[1], reverse=True)
+    return [RankHit(pk, score, similarities.get(pk)) for pk, score in fused[:limit]]
 
 
-def search(slug, query, limit=5):
+def search(slug, query, limit=5, ef=None, filters=None):
+    """
+    Returns the documents closest to the query.
+
+    Depending on the collection's retrieval mode, dense results are fused
+    with full-text results, and keyword-like queries are answered from the
+    full-text index alone (without embedding the query).
+
+    filters can restrict the results by domain, page, file and published_at,
+    see context.embeddings.qdrant_filter.
+    """
+    return search_many(slug, [query], limit, ef, filters)[0]
+
+
+def search_many(slug, queries: List[str], limit=5, ef=None, filters=None):
+    """Like search, for many queries at once. Returns the hits per query."""
     collection = Collection.objects.get(slug=slug)
-    if collection.use_openai:
-        embedding = generate_embeddings_openai([query])
-    else:
-        embedding = generate_embeddings([query], load_encoder(collection.language))
+    mode = collection.retrieval_mode
+
+    results: List[Optional[List]] = [None] * len(queries)
+    lexical: Dict[int, List[RankHit]] = {}
+
+    if mode != "dense":
+        for i, query in enumerate(queries):
+            lexical[i] = lexical_search(collection, query, limit, filters)
+            if mode == "auto" and lexical[i] and is_keyword_query(query):
+                results[i] = lexical[i]
+
+    pending = [i for i, hits in enumerate(results) if hits is None]
+    dense = dense_search(collection, [queries[i] for i in pending], limit, ef, filters)
+
+    for i, hits in zip(pending, dense):
+        results[i] = hits if mode == "dense" else fuse([hits, lexical[i]], limit)
+
+    return results
+
+
+def dense_search(
+    collection: Collection, queries: List[str], limit=5, ef=None, filters=None
+):
+    """Vector search for many queries, embedded in one call and searched in one request."""
+    if not queries:
+        return []
+
+    embeddings = embed_queries(queries, collection)
+
+    if uses_local_index(collection):
+        ids = None
+        if filters:
+            ids = list(
+                Document.objects.filter(
+                    collection=collection, **document_filter(filters)
+                ).values_list("pk", flat=True)
+            )
+        index = LocalIndex(collection.slug)
+        return [index.search(embedding, limit, ids=ids) for embedding in embeddings]
 
     with qdrant_client() as client:
-        result = client.search(collection.slug, embedding[0], limit=limit)
-    return result
+        return client.search_batch(
+            collection.slug,
+            [
+                models.SearchRequest(
+                    vector=embedding.tolist(),
+                    filter=qdrant_filter(filters),
+                    limit=limit,
+                    params=search_params(collection, ef),
+                )
+                for embedding in embeddings
+            ],
+        )
 
 
-def get_documents(result):
-    pks = [r.id for r in result]
-    scores = [r.score for r in result]
-    docs = list(Document.objects.filter(pk__in=pks).prefetch_related("page"))
+async def asearch(slug, query, limit=5, ef=None, filters=None):
+    """Async variant of search."""
+    return (await asearch_many(slug, [query], limit, ef, filters))[0]
+
+
+async def asearch_many(slug, queries: List[str], limit=5, ef=None, filters=None):
+    """
+    Async variant of search_many, slug can also be the collection itself.
+
+    The full-text search runs while the other queries are embedded and
+    searched. Keyword-like queries are only embedded (afterwards) in auto
+    mode when the full-text index has nothing for them.
+    """
+    if isinstance(slug, Collection):
+        collection = slug
+    else:
+        collection = await Collection.objects.aget(slug=slug)
+    mode = collection.retrieval_mode
+
+    dense_queries = [
+        i
+        for i, query in enumerate(queries)
+        if mode != "auto" or not is_keyword_query(query)
+    ]
+    dense_request = adense_search(
+        collection, [queries[i] for i in dense_queries], limit, ef, filters
+    )
 
-    docs = [
-        x for _, x in sorted(zip(scores, docs), key=lambda pair: pair[0], reverse=True)
+    if mode == "dense":
+        return await dense_request
+
+    lexical, hits = await asyncio.gather(
+        sync_to_async(
+            lambda: [
+                lexical_search(collection, query, limit, filters) for query in queries
+            ]
+        )(),
+        dense_request,
+    )
+    dense = dict(zip(dense_queries, hits))
+
+    missing = [i for i in range(len(queries)) if i not in dense and not lexical[i]]
+    hits = await adense_search(
+        collection, [queries[i] for i in missing], limit, ef, filters
+    )
+    dense.update(zip(missing, hits))
+
+    return [
+        fuse([dense[i], lexical[i]], limit) if i in dense else lexical[i]
+        for i in range(len(queries))
     ]
+
+
+async def adense_search(
+    collection: Collection, queries: List[str], limit=5, ef=None, filters=None
+):
+    """Async variant of dense_search."""
+    if not queries:
+        return []
+
+    # Embedding doesn't touch the database, no need to queue on the ORM thread
+    embeddings = await sync_to_async(embed_queries, thread_sensitive=False)(
+        queries, collection
+    )
+
+    if uses_local_index(collection):
+        ids = None
+        if filters:
+            ids = [
+                pk
+                async for pk in Document.objects.filter(
+                    collection=collection, **document_filter(filters)
+                ).values_list("pk", flat=True)
+            ]
+        index = LocalIndex(collection.slug)
+        return await sync_to_async(
+            lambda: [
+                index.search(embedding, limit, ids=ids) for embedding in embeddings
+            ],
+            thread_sensitive=False,
+        )()
+
+    return await get_async_qdrant().search_batch(
+        collection.slug,
+        [
+            models.SearchRequest(
+                vector=embedding.tolist(),
+                filter=qdrant_filter(filters),
+                limit=limit,
+                params=search_params(collection, ef),
+            )
+            for embedding in embeddings
+        ],
+    )
+
+
+def document_cache():
+    if not settings.DOCUMENT_CACHE:
+        return None
+    return caches[settings.DOCUMENT_CACHE]
+
+
+def document_cache_key(pk) -> str:
+    return f"document:{pk}"
+
+
+def load_documents(pks) -> Dict[int, Document]:
+    """
+    Loads documents (with their page) through the document cache, the ones
+    missing there in a single query.
+    """
+    cache = document_cache()
+
+    found = {}
+    if cache is not None:
+        cached = cache.get_many(
+            [document_cache_key(pk) for pk in pks], version=DOCUMENT_CACHE_VERSION
+        )
+        found = {doc.pk: doc for doc in cached.values()}
+
+    missing = [pk for pk in pks if pk not in found]
+    if missing:
+        loaded = {
+            doc.pk: doc
+            for doc in Document.objects.filter(pk__in=missing).select_related("page")
+        }
+        found.update(loaded)
+
+        if cache is not None and loaded:
+            cache.set_many(
+                {document_cache_key(pk): doc for pk, doc in loaded.items()},
+                timeout=settings.DOCUMENT_CACHE_TTL,
+                version=DOCUMENT_CACHE_VERSION,
+            )
+
+    return found
+
+
+def _hydrate(hits, found: Dict[int, Document]) -> List[Document]:
+    docs = []
+    for hit in hits:
+        # Hits without a document were deleted since they were indexed
+        if hit.id in found:
+            doc = copy(found[hit.id])
+            doc.score = hit.score
+            # Cosine similarity, None for hits only found by full-text search
+            if isinstance(hit, RankHit):
+                doc.similarity = hit.similarity
+            else:
+                doc.similarity = hit.score
+            docs.append(doc)
     return docs
+
+
+def get_documents(result):
+    """
+    Returns the documents of search hits, in hit order, with the hit's score
+    and (for dense hits) its cosine similarity.
+    """
+    return _hydrate(result, load_documents({r.id for r in result}))
+
+
+def get_documents_many(results):
+    """Like get_documents for the hits of many queries, loading all documents at once."""
+    found = load_documents({r.id for hits in results for r in hits})
+    return [_hydrate(hits, found) for hits in results]
+
+
+async def aget_documents(result):
+    """Async variant of get_documents."""
+    return await sync_to_async(get_documents)(result)
+
+
+def forget_documents(pks):
+    cache = document_cache()
+    if cache is not None:
+        cache.delete_many(
+            [document_cache_key(pk) for pk in pks], version=DOCUMENT_CACHE_VERSION
+        )
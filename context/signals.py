@@ -0,0 +1,21 @@
+from django.db import transaction
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
+
+from context.models import Document
+from context.search import forget_documents
+from crawler.models import Page
+
+
+@receiver([post_save, post_delete], sender=Document)
+def forget_document(sender, instance: Document, **kwargs):
+    # After the commit, otherwise a concurrent search could cache the old row again
+    pk = instance.pk
+    transaction.on_commit(lambda: forget_documents([pk]))
+
+
+# Deleted pages cascade to their documents, which are handled above
+@receiver(post_save, sender=Page)
+def forget_page_documents(sender, instance: Page, **kwargs):
+    pks = list(instance.document_set.values_list("pk", flat=True))
+    transaction.on_commit(lambda: forget_documents(pks))
@@ -1,6 +1,6 @@
 from celery import shared_task
 
-from context.embeddings import index_documents, reindex_documents
+from context.embeddings import RebuildInProgress, index_documents, reindex_documents
 from context.models import Collection
 
 
@@ -9,6 +9,11 @@ def index_documents_task(pk):
     index_documents(Collection.objects.get(pk=pk))
 
 
-@shared_task
+@shared_task(
+    autoretry_for=(RebuildInProgress,),
+    retry_backoff=True,
+    retry_backoff_max=600,
+    max_retries=None,
+)
 def reindex_documents_task(pk):
     reindex_documents(Collection.objects.get(pk=pk))
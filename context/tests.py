@@ -1,3 +1,175 @@
-from django.test import TestCase
+import tempfile
+from datetime import datetime
 
-# Create your tests here.
+import numpy as np
+from django.test import SimpleTestCase, override_settings
+from qdrant_client import models
+
+from context.batching import MAX_BATCH_INPUTS, _too_large, pack
+from context.embeddings import delete_vectors, qdrant_filter
+from context.lexical import RankHit
+from context.models import Collection
+from context.search import fuse
+from context.vector_index import Hit, LocalIndex
+
+
+class LocalIndexTest(SimpleTestCase):
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+
+        settings = override_settings(
+            VECTOR_INDEX_DIR=directory.name, VECTOR_INDEX_USE_NUMBA=False
+        )
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        self.index = LocalIndex("test")
+        self.index.create(3)
+
+    def test_search_orders_by_cosine_similarity(self):
+        self.index.upsert([1, 2, 3], [[1, 0, 0], [0, 1, 0], [1, 1, 0]])
+
+        hits = self.index.search([2, 0, 0], limit=2)
+
+        self.assertEqual([hit.id for hit in hits], [1, 3])
+        self.assertAlmostEqual(hits[0].score, 1.0, places=2)
+        self.assertAlmostEqual(hits[1].score, 2**-0.5, places=2)
+
+    def test_search_offset_and_ids(self):
+        self.index.upsert([1, 2, 3], [[1, 0, 0], [0, 1, 0], [1, 1, 0]])
+
+        self.assertEqual([hit.id for hit in self.index.search([1, 0, 0], 1, 1)], [3])
+        self.assertEqual(
+            [hit.id for hit in self.index.search([1, 0, 0], 5, ids=[2, 3])], [3, 2]
+        )
+
+    def test_upsert_replaces_rows(self):
+        self.index.upsert([1, 2], [[1, 0, 0], [0, 1, 0]])
+        self.index.upsert([1], [[0, 0, 1]])
+
+        self.assertEqual(len(self.index.rows()), 2)
+        np.testing.assert_allclose(self.index.retrieve(1), [0, 0, 1], atol=1e-3)
+
+    def test_delete(self):
+        self.index.upsert([1, 2], [[1, 0, 0], [0, 1, 0]])
+        self.index.delete([1])
+
+        self.assertIsNone(self.index.retrieve(1))
+        self.assertEqual([hit.id for hit in self.index.search([1, 1, 0])], [2])
+
+    def test_empty_index(self):
+        self.assertEqual(self.index.search([1, 0, 0]), [])
+        self.assertIsNone(self.index.retrieve(1))
+
+    def test_ensure_keeps_an_existing_index(self):
+        self.index.upsert([1], [[1, 0, 0]])
+
+        self.assertFalse(self.index.ensure(5))
+        self.assertEqual(self.index.dimension(), 3)
+        self.assertTrue(LocalIndex("other").ensure(5))
+        self.assertEqual(LocalIndex("other").dimension(), 5)
+
+    def test_replace_with(self):
+        self.index.upsert([1], [[1, 0, 0]])
+        rebuilt = LocalIndex("test.v1")
+        rebuilt.create(2)
+        rebuilt.upsert([2], [[0, 1]])
+
+        self.index.replace_with(rebuilt)
+
+        self.assertFalse(rebuilt.exists())
+        self.assertEqual(self.index.dimension(), 2)
+        self.assertEqual([hit.id for hit in self.index.search([0, 1])], [2])
+
+
+class FuseTest(SimpleTestCase):
+    def test_reciprocal_rank_fusion(self):
+        dense = [Hit(1, 0.9), Hit(2, 0.8)]
+        lexical = [RankHit(2, 12.0), RankHit(3, 4.0)]
+
+        fused = fuse([dense, lexical], limit=3)
+
+        self.assertEqual([hit.id for hit in fused], [2, 1, 3])
+        self.assertAlmostEqual(fused[0].score, 1 / 62 + 1 / 61)
+
+    def test_keeps_the_similarity_of_dense_hits(self):
+        fused = fuse([[Hit(1, 0.9)], [RankHit(2, 3.0)]], limit=5)
+
+        self.assertEqual({hit.id: hit.similarity for hit in fused}, {1: 0.9, 2: None})
+
+    def test_limit(self):
+        self.assertEqual(len(fuse([[Hit(i, 0.5) for i in range(10)]], limit=3)), 3)
+
+
+class PackTest(SimpleTestCase):
+    def test_batches_stay_within_the_token_limit(self):
+        items = [(i, str(i), tokens) for i, tokens in enumerate([4, 4, 4, 9, 1])]
+
+        batches = pack(items, max_tokens=9)
+
+        self.assertEqual(
+            [[item[0] for item in batch] for batch in batches], [[0, 1], [2], [3], [4]]
+        )
+
+    def test_an_oversized_item_gets_its_own_batch(self):
+        batches = pack([(0, "a", 20), (1, "b", 1)], max_tokens=10)
+
+        self.assertEqual([len(batch) for batch in batches], [1, 1])
+
+    def test_batches_stay_within_the_input_limit(self):
+        items = [(i, "a", 1) for i in range(MAX_BATCH_INPUTS + 1)]
+
+        self.assertEqual(
+            [len(batch) for batch in pack(items, max_tokens=10**9)],
+            [MAX_BATCH_INPUTS, 1],
+        )
+
+
+class APIError(Exception):
+    def __init__(self, message, code=None):
+        super().__init__(message)
+        self.code = code
+
+
+class TooLargeTest(SimpleTestCase):
+    def test_size_errors(self):
+        self.assertTrue(_too_large(APIError("", code="context_length_exceeded")))
+        self.assertTrue(
+            _too_large(APIError("This model's maximum context length is 8192"))
+        )
+
+    def test_other_errors(self):
+        self.assertFalse(_too_large(APIError("Invalid model", code="model_not_found")))
+
+
+class QdrantFilterTest(SimpleTestCase):
+    def test_no_filters(self):
+        self.assertIsNone(qdrant_filter(None))
+        self.assertIsNone(qdrant_filter({}))
+
+    def test_conditions(self):
+        after = datetime(2024, 1, 1)
+        conditions = qdrant_filter(
+            {"domain": "example.com", "file": "3", "published_after": after}
+        ).must
+
+        self.assertEqual(
+            conditions,
+            [
+                models.FieldCondition(
+                    key="domain", match=models.MatchAny(any=["example.com"])
+                ),
+                models.FieldCondition(key="file", match=models.MatchValue(value=3)),
+                models.FieldCondition(
+                    key="published_at", range=models.DatetimeRange(gte=after)
+                ),
+            ],
+        )
+
+
+class DeleteVectorsTest(SimpleTestCase):
+    def test_refuses_filters_without_conditions(self):
+        for filters in [{}, {"domain": []}, {"file": None}]:
+            with self.assertRaises(ValueError):
+                delete_vectors(Collection(slug="test"), filters)
@@ -2,6 +2,7 @@ from django.urls import path
 
 from context.views import (
     query_context,
+    query_context_batch,
     search_view,
     upload_file,
     list_files,
@@ -17,6 +18,7 @@ app_name = "context"
 
 urlpatterns = [
     path("search/", query_context, name="search-api"),
+    path("search/batch/", query_context_batch, name="search-batch-api"),
     path("<slug:slug>/manage/", manage_collection, name="manage-collection"),
     path("<slug:slug>/files/", list_files, name="file-list"),
     path("<slug:slug>/documents/", list_documents, name="document-list"),
@@ -0,0 +1,227 @@
+"""
+Embedded vector index for small collections and deployments without Qdrant.
+
+Each index is a single file: a 16 byte header (magic and dimension) followed
+by rows of (id, float16 vector). Vectors are normalized on write, so the dot
+product is the cosine similarity. Readers memory-map the file, writers append
+under a file lock and replace the whole file (atomically) to delete rows.
+"""
+
+import fcntl
+import os
+import threading
+from contextlib import contextmanager
+from functools import lru_cache
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+from django.conf import settings
+
+MAGIC = b"AIRVEC01"
+HEADER_SIZE = 16
+
+# Rows converted to float32 at once by the numpy kernel
+CHUNK_SIZE = 8192
+
+
+class Hit(NamedTuple):
+    id: int
+    score: float
+
+
+def _dtype(dimension: int) -> np.dtype:
+    return np.dtype([("id", "<i8"), ("vector", "<f2", (dimension,))])
+
+
+def _normalize(vectors) -> np.ndarray:
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.where(norms == 0, 1, norms)
+
+
+def _scores_numpy(vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+    scores = np.empty(len(vectors), dtype=np.float32)
+    for start in range(0, len(vectors), CHUNK_SIZE):
+        chunk = vectors[start : start + CHUNK_SIZE]
+        scores[start : start + CHUNK_SIZE] = chunk.astype(np.float32) @ query
+    return scores
+
+
+@lru_cache(maxsize=None)
+def _numba_kernel():
+    from numba import njit, prange
+
+    @njit(parallel=True, fastmath=True)
+    def scores(vectors, query):
+        n, d = vectors.shape
+        out = np.empty(n, dtype=np.float32)
+        for i in prange(n):
+            acc = np.float32(0.0)
+            for j in range(d):
+                acc += np.float32(vectors[i, j]) * query[j]
+            out[i] = acc
+        return out
+
+    return scores
+
+
+_numba_failed = False
+
+
+def scores(vectors: np.ndarray, query: np.ndarray) -> np.ndarray:
+    """Dot products of all float16 rows with a float32 query."""
+    global _numba_failed
+    if settings.VECTOR_INDEX_USE_NUMBA and not _numba_failed:
+        try:
+            return _numba_kernel()(vectors, query)
+        except Exception as ex:
+            # e.g. a numba version without float16 support
+            print("Numba kernel unavailable, using numpy:", ex)
+            _numba_failed = True
+    return _scores_numpy(vectors, query)
+
+
+_maps_lock = threading.Lock()
+_maps: Dict[Path, Tuple[Tuple[int, int], np.ndarray]] = {}
+
+
+class LocalIndex:
+    def __init__(self, name: str):
+        self.name = name
+        self.path = Path(settings.VECTOR_INDEX_DIR) / f"{name}.vec"
+        self._locked = False
+
+    def exists(self) -> bool:
+        return self.path.exists()
+
+    def dimension(self) -> Optional[int]:
+        try:
+            with open(self.path, "rb") as f:
+                header = f.read(HEADER_SIZE)
+        except FileNotFoundError:
+            return None
+        return int(np.frombuffer(header, dtype="<i8", offset=len(MAGIC))[0])
+
+    @contextmanager
+    def _lock(self):
+        # Reentrant, so a caller holding lock() can use the writing methods
+        if self._locked:
+            yield
+            return
+
+        self.path.parent.mkdir(parents=True, exist_ok=True)
+        with open(f"{self.path}.lock", "w") as lock:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+            self._locked = True
+            try:
+                yield
+            finally:
+                self._locked = False
+                fcntl.flock(lock, fcntl.LOCK_UN)
+
+    def lock(self):
+        """Holds off other writers, e.g. to check and change the index in one step."""
+        return self._lock()
+
+    def _write(self, dimension: int, rows: np.ndarray):
+        tmp = self.path.with_suffix(".tmp")
+        with open(tmp, "wb") as f:
+            f.write(MAGIC + np.array([dimension], dtype="<i8").tobytes())
+            f.write(rows.tobytes())
+        os.replace(tmp, self.path)
+
+    def create(self, dimension: int):
+        with self._lock():
+            self._write(dimension, np.empty(0, dtype=_dtype(dimension)))
+
+    def ensure(self, dimension: int) -> bool:
+        """Creates the index unless it exists, returns whether it was created."""
+        with self._lock():
+            if self.exists():
+                return False
+            self._write(dimension, np.empty(0, dtype=_dtype(dimension)))
+            return True
+
+    def drop(self):
+        with self._lock():
+            self.path.unlink(missing_ok=True)
+
+    def replace_with(self, other: "LocalIndex"):
+        """Atomically swaps in the rows of another index (e.g. a rebuilt version)."""
+        with self._lock():
+            os.replace(other.path, self.path)
+        Path(f"{other.path}.lock").unlink(missing_ok=True)
+
+    def rows(self) -> np.ndarray:
+        """Memory-mapped rows, re-mapped when the file was appended to or replaced."""
+        stat = os.stat(self.path)
+        key = (stat.st_ino, stat.st_size)
+
+        with _maps_lock:
+            cached = _maps.get(self.path)
+            if cached is not None and cached[0] == key:
+                return cached[1]
+
+        dtype = _dtype(self.dimension())
+        count = (stat.st_size - HEADER_SIZE) // dtype.itemsize
+        if count == 0:
+            rows = np.empty(0, dtype=dtype)
+        else:
+            rows = np.memmap(
+                self.path, dtype=dtype, mode="r", offset=HEADER_SIZE, shape=(count,)
+            )
+
+        with _maps_lock:
+            _maps[self.path] = (key, rows)
+        return rows
+
+    def upsert(self, ids: List[int], vectors):
+        vectors = _normalize(vectors)
+
+        with self._lock():
+            # Read under the lock, the index may have been replaced meanwhile
+            dimension = self.dimension()
+            new = np.empty(len(ids), dtype=_dtype(dimension))
+            new["id"] = ids
+            new["vector"] = vectors
+
+            rows = self.rows()
+            replaced = np.isin(rows["id"], new["id"])
+            if replaced.any():
+                self._write(dimension, np.concatenate([rows[~replaced], new]))
+            else:
+                with open(self.path, "ab") as f:
+                    f.write(new.tobytes())
+
+    def delete(self, ids: List[int]):
+        with self._lock():
+            rows = self.rows()
+            deleted = np.isin(rows["id"], ids)
+            if deleted.any():
+                self._write(self.dimension(), np.array(rows[~deleted]))
+
+    def retrieve(self, id: int) -> Optional[np.ndarray]:
+        rows = self.rows()
+        found = np.flatnonzero(rows["id"] == id)
+        if len(found) == 0:
+            return None
+        return rows["vector"][found[0]].astype(np.float32)
+
+    def search(
+        self, vector, limit: int = 5, offset: int = 0, ids: Optional[List[int]] = None
+    ) -> List[Hit]:
+        """Returns the nearest rows, optionally only among the given ids."""
+        rows = self.rows()
+        if ids is not None:
+            rows = rows[np.isin(rows["id"], ids)]
+        if len(rows) == 0:
+            return []
+
+        similarities = scores(rows["vector"], _normalize(vector))
+
+        k = min(limit + offset, len(similarities))
+        top = np.argpartition(-similarities, k - 1)[:k]
+        top = top[np.argsort(-similarities[top])][offset:]
+
+        return [Hit(int(rows["id"][i]), float(similarities[i])) for i in top]
@@ -1,6 +1,7 @@
 # Create your views here.
 import os
 import tempfile
+from datetime import datetime, time
 from docling.document_converter import DocumentConverter
 from docling.datamodel.base_models import InputFormat
 from docling.document_converter import DocumentConverter, PdfFormatOption
@@ -19,8 +20,10 @@ from tika import parser
 from hashlib import sha1
 
 from django.urls import reverse
+from django.utils.dateparse import parse_date, parse_datetime
 from context.embeddings import (
     delete_documents,
+    delete_vectors,
     insert_document,
     update_document as update_document_qd,
     update_documents,
@@ -28,7 +31,9 @@ from context.embeddings import (
 from context.models import Document, File, Collection
 from django.http import JsonResponse
 from django.shortcuts import render, redirect
+from django.conf import settings
 from rest_framework.decorators import api_view
+from rest_framework.exceptions import ValidationError
 from rest_framework.response import Response
 
 from django.contrib.auth.decorators import login_required
@@ -37,10 +42,48 @@ from django.contrib.auth.models import User
 from django.core.exceptions import PermissionDenied
 
 
-from context.search import get_documents, search
+from context.search import get_documents, get_documents_many, search, search_many
 from context.serializers import DocumentSerializer
 
 
+def _search_filters(params) -> dict:
+    """Search filters from query parameters or a JSON body."""
+    filters = {}
+    if hasattr(params, "getlist"):
+        domains = params.getlist("domain")
+    else:
+        domains = params.get("domain")
+    if isinstance(domains, str):
+        domains = [domains]
+    if domains:
+        filters["domain"] = domains
+    for key in ("page", "file"):
+        if params.get(key):
+            try:
+                filters[key] = int(params[key])
+            except (TypeError, ValueError):
+                raise ValidationError({key: "Must be an integer."})
+    for key in ("published_after", "published_before"):
+        if params.get(key):
+            filters[key] = _parse_date_filter(key, params[key])
+    return filters
+
+
+def _parse_date_filter(key: str, value) -> datetime:
+    try:
+        parsed = parse_datetime(value)
+        if parsed is None:
+            date = parse_date(value)
+            if date is not None:
+                parsed = datetime.combine(date, time.min)
+    except (TypeError, ValueError):
+        # Well formatted but invalid, e.g. 2024-02-30
+        parsed = None
+    if parsed is None:
+        raise ValidationError({key: "Must be a date or date and time (ISO 8601)."})
+    return parsed
+
+
 def _check_access(slug: str, user: User):
     c = Collection.objects.get(slug=slug)
     if c.group not in user.groups.all():
@@ -53,12 +96,19 @@ def query_context(request):
     q = request.GET.get("question")
     slug = request.GET.get("collection")
     limit = int(request.GET.get("n", 5))
+    ef = request.GET.get("ef")
     collection = Collection.objects.get(slug=slug)
 
     if collection.require_auth and not request.user.is_authenticated:
         raise PermissionDenied()
 
-    results = search(slug, q, limit)
+    results = search(
+        slug,
+        q,
+        limit,
+        ef=int(ef) if ef else None,
+        filters=_search_filters(request.GET),
+    )
     docs = get_documents(results)
 
     serializer = DocumentSerializer(docs, many=True)
@@ -66,6 +116,42 @@ def query_context(request):
     return Response(serializer.data)
 
 
+@api_view(["POST"])
+def query_context_batch(request):
+    questions = request.data.get("questions", [])
+    slug = request.data.get("collection")
+    limit = int(request.data.get("n", 5))
+    ef = request.data.get("ef")
+    collection = Collection.objects.get(slug=slug)
+
+    if collection.require_auth and not request.user.is_authenticated:
+        raise PermissionDenied()
+
+    if (
+        not isinstance(questions, list)
+        or len(questions) > settings.SEARCH_BATCH_MAX_QUESTIONS
+    ):
+        raise ValidationError(
+            f"questions must be a list of at most {settings.SEARCH_BATCH_MAX_QUESTIONS} strings"
+        )
+
+    questions = [str(question) for question in questions]
+    results = search_many(
+        slug,
+        questions,
+        limit,
+        ef=int(ef) if ef else None,
+        filters=_search_filters(request.data),
+    )
+
+    return Response(
+        [
+            {"question": question, "docs": DocumentSerializer(docs, many=True).data}
+            for question, docs in zip(questions, get_documents_many(results))
+        ]
+    )
+
+
 def search_view(request):
     return render(
         request,
@@ -113,7 +199,11 @@ def delete_file(request, slug):
 
     f = File.objects.get(pk=pk, collection=collection)
 
+    # By payload for points of documents already gone, by id for points
+    # stored without payloads (before payloads were indexed)
+    delete_vectors(collection, {"file": f.pk})
     delete_documents(f.document_set.all())
+    f.document_set.all().delete()
 
     f.delete()
 
@@ -240,7 +330,7 @@ def update_document(request, slug, pk):
         )
 
     doc.content = request.POST["content"]
-    doc.hash = get_hash(doc.content)
+    doc.content_hash = get_hash(doc.content)
 
     doc.save()
 
@@ -0,0 +1,13 @@
+"""Helpers for the Django caches."""
+
+from django.core.cache import BaseCache
+
+
+def increment(cache: BaseCache, key: str):
+    """Increments a counter that never expires, starting it at 1."""
+    if not cache.add(key, 1, timeout=None):
+        try:
+            cache.incr(key)
+        except ValueError:
+            # Evicted between add and incr
+            cache.set(key, 1, timeout=None)
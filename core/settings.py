@@ -72,6 +72,7 @@ MIDDLEWARE = [
     "django.contrib.auth.middleware.AuthenticationMiddleware",
     "django.contrib.messages.middleware.MessageMiddleware",
     "django.middleware.clickjacking.XFrameOptionsMiddleware",
+    "context.middleware.embedding_scope_middleware",
 ]
 
 ROOT_URLCONF = "core.urls"
@@ -206,11 +207,90 @@ AWS_QUERYSTRING_AUTH = False
 
 QDRANT_HOST = env("QDRANT_HOST", default="qdrant")
 QDRANT_PORT = env.int("QDRANT_PORT", default=6333)
+QDRANT_GRPC_PORT = env.int("QDRANT_GRPC_PORT", default=6334)
+QDRANT_PREFER_GRPC = env.bool("QDRANT_PREFER_GRPC", default=False)
+QDRANT_TIMEOUT = env.int("QDRANT_TIMEOUT", default=30)
+
+# "qdrant" or "local" (memory-mapped files in VECTOR_INDEX_DIR), collections can override it
+VECTOR_BACKEND = env.str("VECTOR_BACKEND", default="qdrant")
+VECTOR_INDEX_DIR = env.str(
+    "VECTOR_INDEX_DIR", default=str(BASE_DIR / "store" / "vectors")
+)
+VECTOR_INDEX_USE_NUMBA = env.bool("VECTOR_INDEX_USE_NUMBA", default=False)
+
+# Number of batches buffered between the read, embed and upload stages of the indexer
+INDEXING_QUEUE_SIZE = env.int("INDEXING_QUEUE_SIZE", default=2)
+
+# A collection rebuild running longer than this (seconds) is considered abandoned
+REINDEX_STALE_AFTER = env.int("REINDEX_STALE_AFTER", default=24 * 60 * 60)
 
 OPENAI_KEY = env("OPENAI_KEY", default="")
 
+# Embedding requests are packed by tokens and sent concurrently within a tokens-per-minute budget
+OPENAI_EMBEDDING_BATCH_TOKENS = env.int(
+    "OPENAI_EMBEDDING_BATCH_TOKENS", default=100_000
+)
+OPENAI_EMBEDDING_CONCURRENCY = env.int("OPENAI_EMBEDDING_CONCURRENCY", default=4)
+OPENAI_EMBEDDING_TPM = env.int("OPENAI_EMBEDDING_TPM", default=1_000_000)
+OPENAI_EMBEDDING_RETRIES = env.int("OPENAI_EMBEDDING_RETRIES", default=5)
+
+# Number of LASER encoders kept in memory per process and languages loaded at startup
+LASER_ENCODER_CACHE_SIZE = env.int("LASER_ENCODER_CACHE_SIZE", default=4)
+LASER_WARMUP_LANGUAGES = env.list("LASER_WARMUP_LANGUAGES", default=[])
+
+# Optional shared embedding server (unix socket path or host:port), see context.embedding_server
+EMBEDDING_SERVER_ADDRESS = env.str("EMBEDDING_SERVER_ADDRESS", default="")
+EMBEDDING_SERVER_BATCH_WINDOW = env.float("EMBEDDING_SERVER_BATCH_WINDOW", default=0.01)
+EMBEDDING_SERVER_MAX_BATCH = env.int("EMBEDDING_SERVER_MAX_BATCH", default=64)
+
+# Query embeddings are cached in-process and optionally in a shared Django cache (by alias)
+QUERY_EMBEDDING_CACHE_SIZE = env.int("QUERY_EMBEDDING_CACHE_SIZE", default=1024)
+QUERY_EMBEDDING_CACHE_TTL = env.int("QUERY_EMBEDDING_CACHE_TTL", default=60 * 60)
+QUERY_EMBEDDING_SHARED_CACHE = env.str("QUERY_EMBEDDING_SHARED_CACHE", default="")
+
+# User messages embedded and uploaded per background task, see chat.tasks
+QUESTION_INDEX_BATCH_SIZE = env.int("QUESTION_INDEX_BATCH_SIZE", default=256)
+
+# Thread history sent with each turn (the newest messages within both limits) and page size of GET
+THREAD_HISTORY_MESSAGES = env.int("THREAD_HISTORY_MESSAGES", default=10)
+THREAD_HISTORY_TOKENS = env.int("THREAD_HISTORY_TOKENS", default=4000)
+THREAD_PAGE_SIZE = env.int("THREAD_PAGE_SIZE", default=50)
+
+# Rolling thread summaries (for bots with summarize_threads): newest messages kept out of it, its length
+THREAD_SUMMARY_KEEP_MESSAGES = env.int("THREAD_SUMMARY_KEEP_MESSAGES", default=4)
+THREAD_SUMMARY_MAX_TOKENS = env.int("THREAD_SUMMARY_MAX_TOKENS", default=500)
+
+# Bots are cached per process, invalidated through a version counter in this Django cache (alias)
+BOT_CONFIG_CACHE = env.str("BOT_CONFIG_CACHE", default="default")
+BOT_CONFIG_TTL = env.int("BOT_CONFIG_TTL", default=5 * 60)
+
+# Maximum number of questions per request to the batch search API
+SEARCH_BATCH_MAX_QUESTIONS = env.int("SEARCH_BATCH_MAX_QUESTIONS", default=100)
+
+# Queries with at most this many terms are answered by full-text search in "auto" retrieval mode
+LEXICAL_MAX_TERMS = env.int("LEXICAL_MAX_TERMS", default=3)
+
+# Context packing: documents scoring below this fraction of the best hit, or this similar
+# (word overlap) to a document already in the prompt, are left out
+CONTEXT_MIN_RELATIVE_SCORE = env.float("CONTEXT_MIN_RELATIVE_SCORE", default=0.0)
+CONTEXT_DUPLICATE_SIMILARITY = env.float("CONTEXT_DUPLICATE_SIMILARITY", default=0.9)
+
+# Django cache alias for documents returned by searches, empty disables it. Saved
+# documents are evicted, the TTL bounds how long a search racing a save can keep
+# serving the old row.
+DOCUMENT_CACHE = env.str("DOCUMENT_CACHE", default="default")
+DOCUMENT_CACHE_TTL = env.int("DOCUMENT_CACHE_TTL", default=5 * 60)
+
 INFOMANIAK_KEY = env("INFOMANIAK_KEY", default="")
 
+# Connection pool, timeouts (seconds) and retries of the shared LLM clients, see context.clients
+LLM_TIMEOUT = env.float("LLM_TIMEOUT", default=120)
+LLM_CONNECT_TIMEOUT = env.float("LLM_CONNECT_TIMEOUT", default=5)
+LLM_MAX_RETRIES = env.int("LLM_MAX_RETRIES", default=2)
+LLM_MAX_CONNECTIONS = env.int("LLM_MAX_CONNECTIONS", default=200)
+LLM_MAX_KEEPALIVE_CONNECTIONS = env.int("LLM_MAX_KEEPALIVE_CONNECTIONS", default=50)
+LLM_KEEPALIVE_EXPIRY = env.float("LLM_KEEPALIVE_EXPIRY", default=60)
+
 
 BATON = {
     "SITE_HEADER": "AI Collab",
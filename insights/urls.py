@@ -10,4 +10,5 @@ urlpatterns = [
     path("threads/<uuid:pk>/", views.thread_detail, name="thread-detail"),
     path("messages/<int:pk>/", views.message_detail, name="message-detail"),
     path("stats/", views.stats_view, name="stats"),
+    path("stats/answer-cache/", views.answer_cache_stats, name="answer-cache-stats"),
 ]
@@ -13,6 +13,7 @@ from chat.models import ChatBot, Message, Thread
 from rest_framework.pagination import LimitOffsetPagination
 from rest_framework.request import Request
 
+from chat import answer_cache
 from chat.message import retrieve_questions
 
 from context.embeddings import generate_embeddings_openai
@@ -237,3 +238,18 @@ def stats_view(request):
         },
     )
 
+
+@login_required
+def answer_cache_stats(request):
+    """Hit, miss and bypass counts of the semantic answer cache per bot"""
+    if request.user.is_superuser:
+        available_bots = ChatBot.objects.all()
+    else:
+        available_bots = ChatBot.objects.filter(group__in=request.user.groups.all())
+
+    return JsonResponse(
+        {
+            bot.slug: {"enabled": bot.answer_cache, **answer_cache.bot_stats(bot)}
+            for bot in available_bots
+        }
+    )